@@ -5,15 +5,105 @@ import glob
 import pickle
 import nrrd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from lung_segmentation.crop import ImageCropping
 from lung_segmentation.converters.dicom import DicomConverter
-from lung_segmentation.generators import load_data_2D
-from lung_segmentation.utils import dicom_check, resize_image, split_filename
+from lung_segmentation.generators import load_data_3D, n_patches_3D, patch_foreground
+from lung_segmentation.patches import PatchArchive, INDEX_EXT
+from lung_segmentation.utils import dicom_check, resize_image, split_filename, body_mask
 
 
 LOGGER = logging.getLogger('lungs_segmentation')
 
 
+def preprocess_subject(subject, work_dir, new_spacing=(0.35, 0.35, 0.35), accurate_naming=True,
+                       conversion_method='mitk', save_converted=False, staging='hardlink',
+                       deep_check=False, testing=False, save_cropped=False):
+    """Function to pre-process one DICOM folder (DICOM check, conversion, cropping
+    and resampling). subject is a (DICOM folder, mask folder or None) tuple.
+    It is defined at module level so that it can be run in a process pool.
+    The cropped images are resampled in memory and written to disk only if
+    save_cropped is True (or if they are needed later, i.e. without resampling
+    or for the evaluation masks). It returns the folder, the DICOM file used for
+    the conversion (None if the folder was discarded or its conversion failed),
+    the list of (image, original size, cropped image header) and the list of masks."""
+    folder, mask_folder = subject
+    save_cropped = save_cropped or new_spacing is None
+    images_info = []
+    preprocessed_masks = []
+    LOGGER.info('Processing folder {}'.format(folder))
+    filename, _, _ = dicom_check(str(folder), work_dir,
+                                 deep_check=deep_check, staging=staging)
+    if filename:
+        LOGGER.info('Converting DICOM data to NRRD.')
+        converter = DicomConverter(filename, clean=True,
+                                   bin_path=os.environ.get('bin_path', ''))
+        converted_data = converter.convert(convert_to='nrrd',
+                                           method=conversion_method,
+                                           save2file=save_converted)
+        if converted_data is None:
+            LOGGER.warning('{} could not be converted and will be ignored.'.format(folder))
+            return folder, None, images_info, preprocessed_masks
+        if converter.volume is not None:
+            volume = (converter.volume, converter.header)
+        else:
+            volume = None
+        if mask_folder is not None:
+            LOGGER.info('Cropping the CT images based on the '
+                        'already segmented lung mask.')
+            images = []
+            masks = []
+            # crops of all the masks, each ImageCropping only knows its own
+            crops = {}
+            for mask in os.listdir(mask_folder):
+                if os.path.isfile(os.path.join(mask_folder, mask)):
+                    prefix = 'Raw_data_for_{}'.format('_'.join(mask.split('.')[:-1]))
+                    cropping = ImageCropping(converted_data,
+                                             os.path.join(mask_folder, mask),
+                                             prefix=prefix, volume=volume)
+                    image, mask = cropping.crop_with_mask(
+                        save2file=save_cropped or testing)
+                    crops.update(cropping.cropped)
+                    if image is not None and mask is not None:
+                        images.append(image)
+                        masks.append(mask)
+        else:
+            LOGGER.info('Automatically cropping the CT image to have'
+                        ' one subject per image (or to remove background in case '
+                        'of the original CT has only one subject already).')
+            prefix = 'Raw_data'
+            cropping = ImageCropping(converted_data, prefix=prefix, volume=volume)
+            images = cropping.crop_wo_mask(accurate_naming=accurate_naming,
+                                           save2file=save_cropped)
+            crops = cropping.cropped
+            masks = []
+        LOGGER.info('Found {} subjects in the NRRD file.'.format(len(images)))
+        for j, image in enumerate(images):
+            if new_spacing is not None:
+                LOGGER.info('The cropped images will be now resampled to have '
+                            '{0}x{1}x{2} mm resolution.'
+                            .format(new_spacing[0], new_spacing[1], new_spacing[2]))
+                _, _, img_path, orig_size = resize_image(
+                    image, new_spacing=new_spacing, volume=crops.get(image))
+            else:
+                img_path = image
+                orig_size = None
+            header = crops[image][1] if image in crops else None
+            images_info.append((img_path, orig_size, header))
+            if masks and not testing:
+                if new_spacing is not None:
+                    _, _, mask_path, _= resize_image(masks[j], new_spacing=new_spacing,
+                                                     volume=crops.get(masks[j]))
+                else:
+                    mask_path = masks[j]
+                preprocessed_masks.append(mask_path)
+            elif masks and testing:
+                preprocessed_masks.append(masks[j])
+
+    return folder, filename, images_info, preprocessed_masks
+
+
 class LungSegmentationBase():
     "Base class for lung segmentation"
     def __init__(self, input_path, work_dir, deep_check=False, tl=False):
@@ -50,8 +140,20 @@ class LungSegmentationBase():
         "Function to get data"
         raise NotImplementedError('This method has not been implemented yet.')
 
-    def preprocessing(self, new_spacing=(0.35, 0.35, 0.35), accurate_naming=True):
-        "Function to pre-process the data"
+    def preprocessing(self, new_spacing=(0.35, 0.35, 0.35), accurate_naming=True,
+                      conversion_method='mitk', save_converted=False, staging='hardlink',
+                      n_workers=1, save_cropped=False):
+        """Function to pre-process the data. conversion_method can be 'mitk' (external
+        MitkCLDicom2Nrrd binary) or 'pydicom' (in-process reader, the converted volume
+        is kept in memory and written to disk only if save_converted is True).
+        staging is the way the selected DICOM series is made available in the working
+        directory (see utils.stage_dicoms). With n_workers > 1 the DICOM folders are
+        pre-processed in parallel by a process pool. The cropped images are resampled
+        in memory and saved only if save_cropped is True."""
+        if staging == 'manifest' and conversion_method != 'pydicom':
+            LOGGER.warning('The manifest staging can be used only with the pydicom '
+                           'DICOM reader. Symbolic links will be used instead.')
+            staging = 'symlink'
 
         if os.path.isfile(os.path.join(self.work_dir, 'processed_DICOM.txt')):
             with open(os.path.join(self.work_dir, 'processed_DICOM.txt'), 'r') as f:
@@ -89,63 +191,34 @@ class LungSegmentationBase():
         if self.precomputed_masks:
             self.preprocessed_masks = self.precomputed_masks
 
-        for i, folder in enumerate(self.dcm_folders):
-            LOGGER.info('Processing folder {}'.format(folder))
-            filename, _, _ = dicom_check(str(folder), self.work_dir,
-                                         deep_check=self.deep_check)
-            if filename:
-                LOGGER.info('Converting DICOM data to NRRD.')
-                if os.path.isfile(os.path.join(self.work_dir, 'image_info.p')):
-                    with open(os.path.join(self.work_dir, 'image_info.p'), 'rb') as fp:
-                        self.image_info = pickle.load(fp)
-                converter = DicomConverter(filename, clean=True,
-                                           bin_path=os.environ['bin_path'])
-                converted_data = converter.convert(convert_to='nrrd',
-                                                   method='mitk')
-                if self.mask_paths is not None:
-                    LOGGER.info('Cropping the CT images based on the '
-                                'already segmented lung mask.')
-                    images = []
-                    masks = []
-                    for mask in os.listdir(self.mask_paths[i]):
-                        if os.path.isfile(os.path.join(self.mask_paths[i], mask)):
-                            prefix = 'Raw_data_for_{}'.format('_'.join(mask.split('.')[:-1]))
-                            cropping = ImageCropping(converted_data,
-                                                     os.path.join(self.mask_paths[i], mask),
-                                                     prefix=prefix)
-                            image, mask = cropping.crop_with_mask()
-                            if image is not None and mask is not None:
-                                images.append(image)
-                                masks.append(mask)
-                else:
-                    LOGGER.info('Automatically cropping the CT image to have'
-                                ' one subject per image (or to remove background in case '
-                                'of the original CT has only one subject already).')
-                    prefix = 'Raw_data'
-                    cropping = ImageCropping(converted_data, prefix=prefix)
-                    images = cropping.crop_wo_mask(accurate_naming=accurate_naming)
-                    masks = []
-                LOGGER.info('Found {} subjects in the NRRD file.'.format(len(images)))
-                for j, image in enumerate(images):
-                    if new_spacing is not None:
-                        LOGGER.info('The cropped images will be now resampled to have '
-                                    '{0}x{1}x{2} mm resolution.'
-                                    .format(new_spacing[0], new_spacing[1], new_spacing[2]))
-                        _, _, img_path, orig_size = resize_image(image, new_spacing=new_spacing)
-                    else:
-                        img_path = image
-                        orig_size = None
+        subjects = [(folder, self.mask_paths[i] if self.mask_paths is not None else None)
+                    for i, folder in enumerate(self.dcm_folders)]
+        kwargs = dict(work_dir=self.work_dir, new_spacing=new_spacing,
+                      accurate_naming=accurate_naming, conversion_method=conversion_method,
+                      save_converted=save_converted, staging=staging,
+                      deep_check=self.deep_check, testing=self.testing,
+                      save_cropped=save_cropped)
+        if n_workers > 1 and len(subjects) > 1:
+            LOGGER.info('Pre-processing {0} folders using {1} parallel workers.'
+                        .format(len(subjects), n_workers))
+            executor = ProcessPoolExecutor(max_workers=n_workers)
+            results = executor.map(partial(preprocess_subject, **kwargs), subjects)
+        else:
+            executor = None
+            results = (preprocess_subject(x, **kwargs) for x in subjects)
+        try:
+            # results are merged in the same order as the input folders, no
+            # matter which worker finished first
+            for folder, filename, images, masks in results:
+                if not filename:
+                    continue
+                for img_path, orig_size, header in images:
                     self.preprocessed_images.append(img_path)
                     self.image_info[img_path] = {}
                     self.image_info[img_path]['orig_size'] = orig_size
-                    if masks and not self.testing:
-                        if new_spacing is not None:
-                            _, _, mask_path, _= resize_image(masks[j], new_spacing=new_spacing)
-                        else:
-                            mask_path = masks[j]
-                        self.preprocessed_masks.append(mask_path)
-                    elif masks and self.testing:
-                        self.preprocessed_masks.append(masks[j])
+                    if header is not None:
+                        self.image_info[img_path]['reference_header'] = header
+                self.preprocessed_masks = self.preprocessed_masks + masks
                 with open(os.path.join(self.work_dir, 'processed_DICOM.txt'), 'a') as f:
                     f.write(str(folder)+'\n')
                 with open(os.path.join(self.work_dir, 'processed_NRRD.txt'), 'a') as f:
@@ -154,50 +227,116 @@ class LungSegmentationBase():
 
                 with open(os.path.join(self.work_dir, 'image_info.p'), 'wb') as fp:
                     pickle.dump(self.image_info, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
-    def create_tensors(self, patch_size=(96, 96), save2npy=True):
-        "Function to create the 2D tensor from the 3D images"
-        image_tensor = []
-        LOGGER.info('Creating the patches to fed then into the network.')
-        LOGGER.info('Chosen path size is: {0}x{1}.'.format(patch_size[0], patch_size[1]))
+    def _body_mask(self, image):
+        "Function to compute the body mask of one image, cropped to its region of interest"
+        body = body_mask(nrrd.read(image)[0])
+        roi = self.image_info.get(image, {}).get('roi')
+        if roi is not None:
+            (x0, x1), (y0, y1), (z0, z1) = roi
+            body = body[x0:x1, y0:y1, z0:z1]
+        return body
+
+    def create_tensors(self, patch_size=(96, 96), save2npy=True, whole_slice=False,
+                       skip_background=False):
+        """Function to create the 2D tensor from the 3D images. If whole_slice is True,
+        patch_size is ignored and each axial slice becomes one zero-padded patch, with
+        size equal to the biggest slice rounded up to a multiple of 16 (for the fully
+        convolutional inference). If a region of interest was stored in image_info
+        (see LungSegmentationInference.localize_lungs), only the voxels within it
+        are patched. If skip_background is True (prediction only), the patches
+        without any voxel of the body mask are not extracted at all and the
+        kept ones are stored in image_info (the body masks are computed first,
+        to size the tensor, so each image is read twice)"""
+        skip_background = skip_background and self.testing and not save2npy
+        to_process = []
         for i, image in enumerate(self.preprocessed_images):
-            patch = 0
+            im_base, im_name, _ = split_filename(image)
+            im_path = os.path.join(im_base, im_name)
+            if (not os.path.isfile(im_path+INDEX_EXT)
+                    and not glob.glob(im_path+'_patch[0-9]*.npy')):
+                roi = self.image_info.get(image, {}).get('roi')
+                if roi is not None:
+                    sizes = [stop-start for start, stop in roi]
+                else:
+                    sizes = nrrd.read_header(image)['sizes']
+                to_process.append((i, image, sizes))
+        if whole_slice and to_process:
+            patch_size = tuple(int(np.ceil(max(x[2][d] for x in to_process)/16.)*16)
+                               for d in range(2))
+            LOGGER.info('Creating the whole-slice tensors to fed then into the network.')
+        else:
+            LOGGER.info('Creating the patches to fed then into the network.')
+        LOGGER.info('Chosen path size is: {0}x{1}.'.format(patch_size[0], patch_size[1]))
+        to_process = [(i, image, n_patches_3D(sizes, patch_size=patch_size), None)
+                      for i, image, sizes in to_process]
+        if skip_background:
+            with_kept = []
+            for i, image, n_patches, _ in to_process:
+                kept = patch_foreground(self._body_mask(image), patch_size=patch_size) > 0
+                n_kept = int(np.count_nonzero(kept))
+                LOGGER.info('{0} out of {1} patches contain the subject and will be '
+                            'segmented.'.format(n_kept, n_patches))
+                with_kept.append((i, image, n_kept, kept))
+            to_process = with_kept
+        image_tensor = None
+        if not save2npy and to_process:
+            image_tensor = np.empty((sum(x[2] for x in to_process), patch_size[0],
+                                     patch_size[1], 1), dtype=np.float16)
+        offset = 0
+        for i, image, n_patches, kept in to_process:
             im_base, im_name, ext = split_filename(image)
             im_path = os.path.join(im_base, im_name)
-            if not glob.glob(im_path+'*.npy'):
-                image, _ = nrrd.read(image)
-                im_size = image.shape[:2]
-                if self.preprocessed_masks and not self.testing:
-                    mask = self.preprocessed_masks[i]
-                    mask_base, mask_name, _ = split_filename(mask)
-                    mask_path = os.path.join(mask_base, mask_name)
-                    mask, _ = nrrd.read(mask)
-                for n_slice in range(image.shape[2]):
-                    im_array, info_dict = load_data_2D(
-                        '', '', array=image[:, :, n_slice], img_size=im_size,
-                        patch_size=patch_size, binarize=False, normalization=True,
-                        prediction=self.testing, mb=[])
-                    if self.preprocessed_masks and not self.testing:
-                        mask_array, _ = load_data_2D(
-                            '', '', array=mask[:, :, n_slice], img_size=im_size,
-                            patch_size=patch_size, binarize=True, normalization=False)
-                    if save2npy:
-                        for j in range(im_array.shape[0]):
-                            np.save(im_path+'_patch{}.npy'
-                                    .format(str(patch).zfill(5)), im_array[j, :])
-                            if self.preprocessed_masks:
-                                np.save(mask_path+'_patch{}.npy'
-                                        .format(str(patch).zfill(5)), mask_array[j, :])
-                            patch = patch+1
-                    else:
-                        for j in range(im_array.shape[0]):
-                            image_tensor.append(im_array[j, :])
-                if not save2npy:
-                    if info_dict is not None:
-                        im_name = im_path+ext
-                        self.image_info[im_name]['slices'] = n_slice+1
-                        for k in info_dict[0].keys():
-                            self.image_info[im_name][k] = info_dict[0][k]
-        if image_tensor:
-            self.image_tensor = (np.asarray(image_tensor).reshape(
-                -1, im_array.shape[1], im_array.shape[2], 1))
+            roi = self.image_info.get(image, {}).get('roi')
+            image, _ = nrrd.read(image)
+            slice_ranges = None
+            if roi is not None:
+                # normalized with the intensity range of the whole slices, as
+                # if the image was not cropped
+                (x0, x1), (y0, y1), (z0, z1) = roi
+                slice_ranges = (image[:, :, z0:z1].min(axis=(0, 1)),
+                                image[:, :, z0:z1].max(axis=(0, 1)))
+                image = image[x0:x1, y0:y1, z0:z1]
+            mask_path = None
+            mask = None
+            if self.preprocessed_masks and not self.testing:
+                mask = self.preprocessed_masks[i]
+                mask_base, mask_name, _ = split_filename(mask)
+                mask_path = os.path.join(mask_base, mask_name)
+                mask, _ = nrrd.read(mask)
+                if roi is not None:
+                    mask = mask[x0:x1, y0:y1, z0:z1]
+            if save2npy:
+                archive = PatchArchive(im_path, n_patches, patch_size=patch_size,
+                                       mask_basename=mask_path)
+                images_out = archive.images
+                masks_out = archive.masks
+            else:
+                images_out = image_tensor[offset:offset+n_patches]
+                masks_out = None
+            _, info_dict = load_data_3D(
+                image, patch_size=patch_size, binarize=False, normalization=True,
+                prediction=self.testing, out=images_out, slice_ranges=slice_ranges,
+                kept=kept)
+            if mask is not None and masks_out is not None:
+                load_data_3D(mask, patch_size=patch_size, binarize=True,
+                             normalization=False, out=masks_out)
+            if save2npy:
+                foreground = None
+                if mask is not None:
+                    foreground = (patch_foreground(mask, patch_size=patch_size)
+                                  / float(patch_size[0]*patch_size[1]))
+                archive.close(foreground=foreground)
+            else:
+                offset += n_patches
+                if info_dict:
+                    im_name = im_path+ext
+                    self.image_info[im_name]['slices'] = image.shape[2]
+                    self.image_info[im_name]['kept'] = kept
+                    for k in info_dict[0].keys():
+                        self.image_info[im_name][k] = info_dict[0][k]
+        if image_tensor is not None:
+            self.image_tensor = image_tensor
@@ -6,6 +6,8 @@ STANDARD_CONFIG = {
     'cluster_correction': False,
     'min_extent': 350,
     'dicom_check': True,
+    'roi_spacing': None,
+    'roi_margin': 0,
     'weights_url': ('https://angiogenesis.dkfz.de/oncoexpress'
                     '/software/delineation/bin/weights.tar.gz')}
 
@@ -15,6 +17,8 @@ HIGH_RES_CONFIG = {
     'cluster_correction': True,
     'min_extent': 100000,
     'dicom_check': False,
+    'roi_spacing': None,
+    'roi_margin': 0,
     'weights_url': ('https://angiogenesis.dkfz.de/oncoexpress'
                     '/software/delineation/bin/highres_weights.tar.gz')}
 
@@ -24,6 +28,8 @@ HUMAN_CONFIG = {
     'cluster_correction': True,
     'min_extent': 300000,
     'dicom_check': False,
+    'roi_spacing': None,
+    'roi_margin': 20,
     'weights_url': ('https://angiogenesis.dkfz.de/oncoexpress'
                     '/software/delineation/bin/human_weights.tar.gz')}
 
@@ -33,4 +39,6 @@ CUSTOM_CONFIG = {
     'cluster_correction': False,
     'min_extent': 0,
     'dicom_check': False,
+    'roi_spacing': None,
+    'roi_margin': 0,
     'weights_url': None}
@@ -1,17 +1,46 @@
 from .base import BaseConverter
 import subprocess as sp
 import os
+import logging
 import glob
+import numpy as np
+import nrrd
+import pydicom
+from pydicom.errors import InvalidDicomError
 
 
+LOGGER = logging.getLogger('lungs_segmentation')
+
 class DicomConverter(BaseConverter):
-    
-    def convert(self, convert_to='nifti_gz', method='dcm2niix', force=False):
+
+    volume = None
+    header = None
+
+    def convert(self, convert_to='nifti_gz', method='dcm2niix', force=False, save2file=True):
 
         if convert_to == 'nrrd':
             print('\nConversion from DICOM to NRRD...')
             ext = '.nrrd'
-            if method=='dcm2niix':
+            if self.toConvert.endswith('.txt') and method != 'pydicom':
+                raise Exception('A list of DICOM files can be converted only with the '
+                                'pydicom method.')
+            if method == 'pydicom':
+                outname = os.path.join(self.basedir, self.filename)+ext
+                try:
+                    self.volume, self.header = self.read()
+                    if save2file:
+                        nrrd.write(outname, self.volume, header=self.header)
+                    if self.clean:
+                        self.clean_dir()
+                    print('\nImage successfully converted!')
+                except (InvalidDicomError, ValueError, NotImplementedError):
+                    # unreadable or inconsistent series (or compressed pixel data
+                    # without a decoder), any other error is a bug and is raised
+                    LOGGER.exception('Conversion of {} failed. Scan will be ignored.'
+                                     .format(self.toConvert))
+                    return None
+                return outname
+            elif method=='dcm2niix':
                 cmd = ("dcm2niix -o {0} -f {1} -e y {2}".format(self.basedir, self.filename, self.basedir))
             elif method=='slicer':
                 cmd = (('Slicer --no-main-window --python-code '+'"node=slicer.util.loadVolume('+
@@ -51,6 +80,10 @@ class DicomConverter(BaseConverter):
 
     def clean_dir(self):
 
+        if self.toConvert.endswith('.txt'):
+            # the files listed in the manifest are the original data, never delete them
+            os.remove(self.toConvert)
+            return
         if os.path.isfile(self.toConvert):
             basedir = self.basedir
         elif os.path.isdir(self.toConvert):
@@ -64,3 +97,82 @@ class DicomConverter(BaseConverter):
                 os.remove(f)
         else:
             print('No DICOM files to delete found in {}'.format(basedir))
+
+    def read(self):
+        """Function to read the DICOM series in memory using pydicom, without
+        any external binary. The slices are stacked following their position
+        along the slice normal (ImagePositionPatient) or, if not available,
+        their InstanceNumber. The rescale slope/intercept are applied.
+        It returns the volume, with x, y and z as first, second and third
+        dimension like the NRRD files written by MITK, and a NRRD header with
+        spacing, directions and origin."""
+        if os.path.isdir(self.toConvert):
+            basedir = self.toConvert
+        else:
+            basedir = self.basedir
+        if self.toConvert.endswith('.txt'):
+            # manifest with the paths to the DICOM files (see utils.stage_dicoms)
+            with open(self.toConvert, 'r') as f:
+                dicoms = [x.strip() for x in f if x.strip()]
+        else:
+            dicoms = sorted(glob.glob(os.path.join(basedir, '*')))
+        slices = []
+        for dcm in dicoms:
+            try:
+                header = pydicom.dcmread(dcm)
+            except (InvalidDicomError, IsADirectoryError, PermissionError):
+                continue
+            if 'PixelData' in header:
+                slices.append(header)
+        if not slices:
+            raise ValueError('No DICOM slices found in {}'.format(basedir))
+
+        orientation = np.asarray(getattr(slices[0], 'ImageOrientationPatient',
+                                         [1, 0, 0, 0, 1, 0]), dtype=float)
+        normal = np.cross(orientation[:3], orientation[3:])
+        if all(hasattr(x, 'ImagePositionPatient') for x in slices):
+            positions = [np.dot(normal, np.asarray(x.ImagePositionPatient, dtype=float))
+                         for x in slices]
+            order = np.argsort(positions, kind='mergesort')
+            positions = np.asarray(positions)[order]
+        else:
+            order = np.argsort([int(getattr(x, 'InstanceNumber', 0)) for x in slices],
+                               kind='mergesort')
+            positions = None
+        slices = [slices[i] for i in order]
+
+        slopes = [float(getattr(x, 'RescaleSlope', 1)) for x in slices]
+        intercepts = [float(getattr(x, 'RescaleIntercept', 0)) for x in slices]
+        if (all(x == 1 for x in slopes) and all(x.is_integer() for x in intercepts)):
+            dtype = np.int16
+        else:
+            dtype = np.float32
+        rows, columns = int(slices[0].Rows), int(slices[0].Columns)
+        volume = np.empty((columns, rows, len(slices)), dtype=dtype)
+        for i, dcm in enumerate(slices):
+            pixels = dcm.pixel_array.T
+            if dtype == np.int16:
+                volume[:, :, i] = np.clip(pixels.astype(np.int32)+int(intercepts[i]),
+                                          -32768, 32767)
+            else:
+                volume[:, :, i] = pixels*np.float32(slopes[i]) + np.float32(intercepts[i])
+
+        pixel_spacing = [float(x) for x in getattr(slices[0], 'PixelSpacing', [1, 1])]
+        if positions is not None and len(slices) > 1:
+            space_z = float(np.median(np.diff(positions)))
+        else:
+            space_z = float(getattr(slices[0], 'SpacingBetweenSlices',
+                                    getattr(slices[0], 'SliceThickness', 1)))
+        origin = np.asarray(getattr(slices[0], 'ImagePositionPatient', [0, 0, 0]), dtype=float)
+        header = {'dimension': 3,
+                  'space': 'left-posterior-superior',
+                  'sizes': np.array(volume.shape),
+                  'space directions': np.array([orientation[:3]*pixel_spacing[1],
+                                                orientation[3:]*pixel_spacing[0],
+                                                normal*space_z]),
+                  'kinds': ['domain', 'domain', 'domain'],
+                  'endian': 'little',
+                  'encoding': 'gzip',
+                  'space origin': origin}
+
+        return volume, header
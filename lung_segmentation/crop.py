@@ -24,11 +24,18 @@ MOUSE_NAMES = ['mouse_01', 'mouse_02', 'mouse_03',
 
 class ImageCropping():
 
-    def __init__(self, image, mask=None, prefix=None):
+    def __init__(self, image, mask=None, prefix=None, volume=None):
         LOGGER.info('Starting image cropping...')
 
         self.image = image
         self.mask = mask
+        if volume is not None:
+            self._volume, self._header = volume
+        else:
+            self._volume = None
+            self._header = None
+        self._working_volumes = {}
+        self.cropped = {}
 
         imagePath, imageFilename, imageExt = split_filename(image)
         self.extention = imageExt
@@ -47,11 +54,16 @@ class ImageCropping():
         elif prefix is not None and mask is not None:
             self.imageOutname = os.path.join(imagePath, prefix+'_cropped')+imageExt
 
-    def crop_with_mask(self):
+    def crop_with_mask(self, save2file=True):
+        """Function to crop the image around the provided mask. The cropped image
+        and mask are kept in self.cropped (as (array, header) tuples, keyed by their
+        output names) and written to disk only if save2file is True (NIfTI images
+        are always written)."""
 
         maskData, maskHD = nrrd.read(self.mask)
         if self.extention == '.nrrd':
-            imageData, imageHD = nrrd.read(self.image)
+            imageData, imageHD = self.load_volume()
+            imageHD = imageHD.copy()
 
             space_x = np.abs(imageHD['space directions'][0, 0])
             space_y = np.abs(imageHD['space directions'][1, 1])
@@ -95,17 +107,21 @@ class ImageCropping():
                                      new_z[0]:new_z[1]]
             if self.extention == '.nrrd':
                 imageHD['sizes'] = np.array(croppedImage.shape)
-                nrrd.write(self.imageOutname, croppedImage, header=imageHD)
+                self.cropped[self.imageOutname] = (croppedImage, imageHD)
+                if save2file:
+                    nrrd.write(self.imageOutname, croppedImage, header=imageHD)
             elif self.extention == '.nii.gz':
                 im2save = nib.Nifti1Image(croppedImage, affine=nib.load(self.image).affine)
                 nib.save(im2save, self.imageOutname)
             maskHD['sizes'] = np.array(croppedMask.shape)
-            nrrd.write(self.maskOutname, croppedMask, header=maskHD)
+            self.cropped[self.maskOutname] = (croppedMask, maskHD)
+            if save2file:
+                nrrd.write(self.maskOutname, croppedMask, header=maskHD)
 
         LOGGER.info('Cropping done!')
         return self.imageOutname, self.maskOutname
 
-    def crop_wo_mask(self, accurate_naming=True):
+    def crop_wo_mask(self, accurate_naming=True, save2file=True):
         """
         Function to crop CT images automatically. It will look for edges
         in the middle slice and will crop the image accordingly.
@@ -116,13 +132,16 @@ class ImageCropping():
         in one image. If you are not cropping pre-clinical images or you
         are not interested in keep track of the mice across time-points,
         set this to False.
+        The cropped images are kept in self.cropped (as (array, header) tuples,
+        keyed by their output names) and written to disk only if save2file is True.
         """
 
-        im, imageHD = nrrd.read(self.image)
+        im, imageHD = self.load_volume()
         space_x = np.abs(imageHD['space directions'][0, 0])
         space_y = np.abs(imageHD['space directions'][1, 1])
         space_z = np.abs(imageHD['space directions'][2, 2])
         origin_x = imageHD['space origin'][0]
+        imageHD = imageHD.copy()
         process = True
         indY = None
         out = []
@@ -144,82 +163,36 @@ class ImageCropping():
         _, _, dimZ = im.shape
 
         mean_Z = int(np.ceil((dimZ)/2))
-        n_mice_detected = []
-        not_correct = True
         angle = 0
-        counter = 0
-        while not_correct:
-            im[im<np.min(im)+824] = np.min(im)
-            im[im == 0] = np.min(im)
-            for offset in [20, 10, 0, -10, -20]:
-                _, y1 = np.where(im[:, :, mean_Z+offset] != np.min(im))
-                im[:, np.min(y1)+min_size_y+10:, mean_Z+offset] = 0
-                img2, _, _ = self.find_cluster(im[:, :, mean_Z+offset], space_x)
-                labels = label(img2)
-                regions = regionprops(labels)
-                if regions:
-                    n_mice_detected.append(len(regions))
-                    if offset == 0:
-                        xx = [x for y in [[x.bbox[0], x.bbox[2]] for x in regions] for x in y]
-                        yy = [x for y in [[x.bbox[1], x.bbox[3]] for x in regions] for x in y]
-                else:
-                    n_mice_detected.append(0)
-            if len(set(n_mice_detected)) == 1 or (len(set(n_mice_detected)) == 2 and 0 in set(n_mice_detected)):
-                not_correct = False
-            elif counter < 8:
-                angle = angle - 2
-                LOGGER.warning('Different number of mice have been detected going from down-up '
-                               'in the image. This might be due to an oblique orientation '
-                               'of the mouse trail. The CT image will be rotated about the z '
-                               'direction of %f degrees', np.abs(angle))
-                n_mice_detected = []
-                indY = None
-                im, _ = nrrd.read(self.image)
-                im = rotate(im, angle, (0, 2), reshape=False, order=0)
-                counter += 1
-                if counter % 2 == 0:
-                    mean_Z = mean_Z - 10
-            else:
-                LOGGER.warning('CT image has been rotated of 14° but the number of mice detected '
-                               'is still not the same going from down to up. This CT cannot be '
-                               'cropped properly and will be excluded.')
+        _, working = self.working_volumes(angle)
+        n_mice_detected, xx, yy = self.probe_slices(working, mean_Z, min_size_y, space_x)
+        if not self.consistent_detection(n_mice_detected):
+            angle = self.estimate_tilt(working, mean_Z, min_size_y, min_size_z, space_x)
+            LOGGER.warning('Different number of mice have been detected going from down-up '
+                           'in the image. This might be due to an oblique orientation '
+                           'of the mouse trail. The CT image will be rotated about the z '
+                           'direction of %f degrees', angle)
+            _, working = self.working_volumes(angle)
+            n_mice_detected, xx, yy = self.probe_slices(working, mean_Z, min_size_y, space_x)
+            if not self.consistent_detection(n_mice_detected):
+                LOGGER.warning('CT image has been rotated of %f degrees but the number of mice '
+                               'detected is still not the same going from down to up. This CT '
+                               'cannot be cropped properly and will be excluded.', angle)
                 process = False
-                not_correct = False
 
         if process:
-            im, _ = nrrd.read(self.image)
-            if angle != 0:
-                im = rotate(im, angle, (0, 2), reshape=False, order=0)
-                im[im == 0] = np.min(im)
-            im[im<np.min(im)+824] = np.min(im)
-            im[im == 0] = np.min(im)
-            im = im[xx[0]:xx[1], yy[0]:yy[1], :]
-            hole_size = np.zeros(im.shape[2])
-            offset_z = int((im.shape[2]-min_size_z)/2)
-            for z in range(offset_z, im.shape[2]-offset_z):
-                _, _, zeros = self.find_cluster(im[:, :, z], space_x)
-                hole_size[z] = zeros
+            im, working = self.working_volumes(angle)
+            cropped = working[xx[0]:xx[1], yy[0]:yy[1], :]
+            hole_size = np.zeros(cropped.shape[2])
+            offset_z = int((cropped.shape[2]-min_size_z)/2)
+            hole_size[offset_z:cropped.shape[2]-offset_z] = self.hole_sizes(
+                cropped[:, :, offset_z:cropped.shape[2]-offset_z], space_x)
             mean_Z = np.where(hole_size==np.max(hole_size))[0][0]
-            im, _ = nrrd.read(self.image)
-            if angle != 0:
-                im = rotate(im, angle, (0, 2), reshape=False, order=0)
-                im[im == 0] = np.min(im)
-            im[im<np.min(im)+824] = np.min(im)
-            im[im == 0] = np.min(im)
-
-            _, y1 = np.where(im[:, :, mean_Z] != np.min(im))
-            im[:, np.min(y1)+min_size_y+10:, mean_Z] = 0
-            img2, _, _ = self.find_cluster(im[:, :, mean_Z], space_x)
-            labels = label(img2)
-            regions = regionprops(labels)
+
+            regions = self.probe_slice(working, mean_Z, min_size_y, space_x)
             xx = [x for y in [[x.bbox[0], x.bbox[2]] for x in regions] for x in y]
             yy = [x for y in [[x.bbox[1], x.bbox[3]] for x in regions] for x in y]
 
-            im, _ = nrrd.read(self.image)
-            if angle != 0:
-                im = rotate(im, angle, (0, 2), reshape=False, order=0)
-                im[im == 0] = np.min(im)
-
             average_mouse_size = int(np.round(np.mean([xx[i+1]-xx[i] for i in range(0, len(xx), 2)])))
             fov_mm = space_x*im.shape[0]
             average_hole_size = average_mouse_size // 2
@@ -324,7 +297,8 @@ class ImageCropping():
                 coordinates = {}
                 croppedImage = im[xx[i]-offset_box:xx[i+1]+offset_box, y_min:y_max,
                                   mean_Z-int(min_size_z/2):mean_Z+int(min_size_z/2)]
-                imageHD['sizes'] = np.array(croppedImage.shape)
+                croppedHD = imageHD.copy()
+                croppedHD['sizes'] = np.array(croppedImage.shape)
                 coordinates['x'] = [xx[i]-offset_box, xx[i]+offset_box]
                 coordinates['y'] = [y_min, y_max]
                 coordinates['z'] = [mean_Z-int(min_size_z/2), mean_Z+int(min_size_z/2)]
@@ -332,32 +306,133 @@ class ImageCropping():
                 with open(self.imageOutname+'_{}.p'.format(image_names[n_mice]), 'wb') as fp:
                     pickle.dump(coordinates, fp, protocol=pickle.HIGHEST_PROTOCOL)
 
-                nrrd.write(self.imageOutname+'_{}.nrrd'.format(image_names[n_mice]),
-                           croppedImage, header=imageHD)
-                out.append(self.imageOutname+'_{}.nrrd'.format(image_names[n_mice]))
+                outname = self.imageOutname+'_{}.nrrd'.format(image_names[n_mice])
+                self.cropped[outname] = (croppedImage, croppedHD)
+                if save2file:
+                    nrrd.write(outname, croppedImage, header=croppedHD)
+                out.append(outname)
 
         LOGGER.info('Cropping done!')
         return out
 
+    def load_volume(self):
+        "Function to decode the image only once and keep it in memory"
+        if self._volume is None:
+            self._volume, self._header = nrrd.read(self.image)
+        return self._volume, self._header
+
+    def working_volumes(self, angle=0):
+        """
+        Function to return the pristine image (rotated by angle about the
+        z direction, if different from 0) together with its thresholded working
+        copy. Both of them are computed once and re-used for every probe with
+        the same angle. They must not be modified in place: take a copy of the
+        slice that has to be changed (see probe_slice).
+        """
+        if angle not in self._working_volumes:
+            im, _ = self.load_volume()
+            if angle != 0:
+                im = rotate(im, angle, (0, 2), reshape=False, order=0)
+                im[im == 0] = np.min(im)
+            min_val = np.min(im)
+            working = im.copy()
+            working[working < min_val+824] = min_val
+            working[working == 0] = min_val
+            self._working_volumes = {angle: (im, working)}
+            self._working_min = min_val
+
+        return self._working_volumes[angle]
+
+    def probe_slice(self, working, n_slice, min_size_y, spacing):
+        "Function to detect the subjects in one slice of the thresholded image"
+        probe = working[:, :, n_slice].copy()
+        _, y1 = np.where(probe != self._working_min)
+        probe[:, np.min(y1)+min_size_y+10:] = 0
+        img2, _, _ = self.find_cluster(probe, spacing)
+        labels = label(img2)
+
+        return regionprops(labels)
+
+    def probe_slices(self, working, mean_Z, min_size_y, spacing):
+        """Function to count the subjects in 5 slices around mean_Z. It also returns
+        the x and y edges of the subjects detected in the central slice"""
+        n_mice_detected = []
+        xx = yy = None
+        for offset in [20, 10, 0, -10, -20]:
+            regions = self.probe_slice(working, mean_Z+offset, min_size_y, spacing)
+            if regions:
+                n_mice_detected.append(len(regions))
+                if offset == 0:
+                    xx = [x for y in [[x.bbox[0], x.bbox[2]] for x in regions] for x in y]
+                    yy = [x for y in [[x.bbox[1], x.bbox[3]] for x in regions] for x in y]
+            else:
+                n_mice_detected.append(0)
+
+        return n_mice_detected, xx, yy
+
+    @staticmethod
+    def consistent_detection(n_mice_detected):
+        "Function to check that the same number of subjects was found in all the probes"
+        detected = set(n_mice_detected)
+        return len(detected) == 1 or (len(detected) == 2 and 0 in detected)
+
+    def estimate_tilt(self, working, mean_Z, min_size_y, min_size_z, spacing):
+        """
+        Function to estimate, in closed form, the angle (in degrees) by which the
+        image has to be rotated about the z direction (i.e. in the x-z plane) to
+        have the subjects aligned with z. The thresholded image above the bed is
+        projected along y and the angle is the area-weighted mean orientation of
+        the principal axes of the elongated clusters in the projection.
+        """
+        _, y1 = np.where(working[:, :, mean_Z] != self._working_min)
+        y0 = np.min(y1)
+        projection = np.any(working[:, y0:y0+min_size_y+10, :] != self._working_min, axis=1)
+        angles = []
+        areas = []
+        for region in regionprops(label(projection)):
+            x, z = region.coords[:, 0], region.coords[:, 1]
+            if z.max()-z.min() < min_size_z/2 or region.area < 100/spacing:
+                continue
+            cov = np.cov(np.stack([x, z]))
+            angles.append(0.5*np.arctan2(2*cov[0, 1], cov[1, 1]-cov[0, 0]))
+            areas.append(region.area)
+        if not angles:
+            return 0
+
+        return float(np.degrees(np.average(angles, weights=areas)))
+
     def find_cluster(self, im, spacing):
 
-        im[im==np.min(im)] = 0
-        im[im!=0] = 1
+        im = ((im != np.min(im)) & (im != 0)).astype(np.uint8)
 
         nb_components, output, stats, _ = (
-            cv2.connectedComponentsWithStats(im.astype(np.uint8),
-                                             connectivity=8))
+            cv2.connectedComponentsWithStats(im, connectivity=8))
         sizes = stats[1:, -1]
-        nb_components = nb_components - 1
         min_size = 100/spacing
-        img2 = np.zeros((output.shape))
-        cluster_size = []
-        for i in range(0, nb_components):
-            if sizes[i] >= min_size:
-                cluster_size.append(sizes[i])
-                img2[output == i + 1] = 1
+        # look-up table with one entry per label (0 is the background)
+        keep = np.zeros(nb_components, dtype=bool)
+        keep[1:] = sizes >= min_size
+        img2 = keep[output].astype(np.uint8)
+        cluster_size = list(sizes[keep[1:]])
         img2_filled = ndimage.binary_fill_holes(img2)
-        zeros = np.sum(img2_filled-img2)
+        zeros = np.count_nonzero(img2_filled) - np.count_nonzero(img2)
 
         return img2, cluster_size, zeros
-    
\ No newline at end of file
+
+    def hole_sizes(self, volume, spacing):
+        """Function to compute, for every axial slice of volume at once, the
+        number of zeros returned by find_cluster. The slices are labelled and
+        filled together with structuring elements that do not connect
+        neighbouring slices."""
+        mins = volume.min(axis=(0, 1))
+        binary = (volume != mins) & (volume != 0)
+        in_plane = np.zeros((3, 3, 3), dtype=bool)
+        in_plane[:, :, 1] = True
+        labels, _ = ndimage.label(binary, structure=in_plane)
+        keep = np.bincount(labels.ravel()) >= 100/spacing
+        keep[0] = False
+        clusters = keep[labels]
+        in_plane[:, :, 1] = ndimage.generate_binary_structure(2, 1)
+        filled = ndimage.binary_fill_holes(clusters, structure=in_plane)
+
+        return np.sum(filled & ~clusters, axis=(0, 1))
@@ -204,14 +204,14 @@ class BaseDataset(object):
 
                 if enum_idx == 0:
                     if self.num_inputs == 1:
-                        inputs = np.empty((len(load_range), *_parse_shape(input_sample))).astype('float32')
+                        inputs = np.empty((len(load_range), *_parse_shape(input_sample)), dtype='float32')
                     else:
-                        inputs = [np.empty((len(load_range), *_parse_shape(input_sample[i]))).astype('float32') for i in range(self.num_inputs)]
+                        inputs = [np.empty((len(load_range), *_parse_shape(input_sample[i])), dtype='float32') for i in range(self.num_inputs)]
 
                     if self.num_targets == 1:
-                        targets = np.empty((len(load_range), *_parse_shape(target_sample))).astype('float32')
+                        targets = np.empty((len(load_range), *_parse_shape(target_sample)), dtype='float32')
                     else:
-                        targets = [np.empty((len(load_range), *_parse_shape(target_sample[i]))).astype('float32') for i in range(self.num_targets)]
+                        targets = [np.empty((len(load_range), *_parse_shape(target_sample[i])), dtype='float32') for i in range(self.num_targets)]
 
                 if self.num_inputs == 1:
                     inputs[enum_idx] = input_sample
@@ -235,9 +235,9 @@ class BaseDataset(object):
 
                 if enum_idx == 0:
                     if self.num_inputs == 1:
-                        inputs = np.empty((len(load_range), *_parse_shape(input_sample))).astype('float32')
+                        inputs = np.empty((len(load_range), *_parse_shape(input_sample)), dtype='float32')
                     else:
-                        inputs = [np.empty((len(load_range), *_parse_shape(input_sample[i]))).astype('float32') for i in range(self.num_inputs)]
+                        inputs = [np.empty((len(load_range), *_parse_shape(input_sample[i])), dtype='float32') for i in range(self.num_inputs)]
 
                 if self.num_inputs == 1:
                     inputs[enum_idx] = input_sample
@@ -417,15 +417,14 @@ class CSVDataset(BaseDataset):
         - list of new datasets with transforms copied
         """
         if isinstance(col, int):
-            split_vals = self.df.iloc[:,col].values.flatten()
+            split_vals = np.asarray(self.df.iloc[:,col]).ravel()
             
             new_df_list = []
             for unique_split_val in np.unique(split_vals):
                 new_df = self.df[:][self.df.iloc[:,col]==unique_split_val]
                 new_df_list.append(new_df)
         elif isinstance(col, str):
-            split_vals = self.df.loc[:,col].values.flatten()
-            print(np.unique(split_vals))
+            split_vals = np.asarray(self.df.loc[:,col]).ravel()
             new_df_list = []
             for unique_split_val in np.unique(split_vals):
                 new_df = self.df[:][self.df.loc[:,col]==unique_split_val]
@@ -470,6 +469,258 @@ class CSVDataset(BaseDataset):
                           base_path=self.base_path)
 
 
+class PatchArchiveDataset(CSVDataset):
+
+    def __init__(self,
+                 filepath,
+                 input_cols=['images'],
+                 target_cols=['masks'],
+                 index_col='patch',
+                 foreground_col='foreground',
+                 input_transform=None,
+                 target_transform=None,
+                 co_transform=None,
+                 co_transforms_first=False,
+                 base_path=None):
+        """
+        Initialize a Dataset from a CSV file/dataframe where each row points to
+        one patch stored in a memory-mappable archive (see patches.PatchArchive).
+        The archives are opened lazily with np.load(..., mmap_mode='r') and kept
+        open, so reading a sample does not need any file open.
+
+        Arguments
+        ---------
+        index_col : string
+            name of the column with the position of the patch within the archive.
+            Rows with negative position (or CSV files without this column) are
+            treated as one .npy file per patch.
+
+        foreground_col : string
+            name of the column with the fraction of foreground voxels of each
+            mask patch (see patches.PatchArchive). It is stored in self.foreground
+            (None if the CSV file has no such column) and can be used to sample
+            the patches, e.g. with generators.ForegroundSampler.
+
+        All the other arguments are the same as CSVDataset.
+        """
+        CSVDataset.__init__(self, filepath, input_cols=input_cols, target_cols=target_cols,
+                            input_transform=input_transform, target_transform=target_transform,
+                            co_transform=co_transform, co_transforms_first=co_transforms_first,
+                            base_path=base_path)
+        self.index_col = index_col
+        if index_col in self.df.columns:
+            self.patches = self.df.loc[:, index_col].values.astype('int64')
+        else:
+            self.patches = np.zeros(len(self.df), dtype='int64')-1
+        self.foreground_col = foreground_col
+        if foreground_col in self.df.columns:
+            self.foreground = self.df.loc[:, foreground_col].values.astype('float64')
+        else:
+            self.foreground = None
+        self._archives = {}
+
+    def _archive(self, path):
+        try:
+            archive = self._archives[path]
+        except KeyError:
+            archive = np.load(os.path.join(self.base_path, path), mmap_mode='r')
+            self._archives[path] = archive
+        return archive
+
+    def _read(self, path, patch):
+        if patch < 0:
+            return np.load(os.path.join(self.base_path, path))
+        return np.array(self._archive(path)[patch])
+
+    def _read_batch(self, paths, patches):
+        if np.any(patches < 0):
+            return np.stack([self._read(p, n) for p, n in zip(paths, patches)], 0)
+        first = self._archive(paths[0])
+        batch = np.empty((len(paths),)+first.shape[1:], dtype=first.dtype)
+        for path in np.unique(paths):
+            selected = np.where(paths == path)[0]
+            order = np.argsort(patches[selected])
+            batch[selected[order]] = self._archive(path)[patches[selected[order]]]
+        return batch
+
+    def __getitem__(self, index):
+        """
+        Index the dataset and return the input + target
+        """
+        patch = self.patches[index]
+        input_sample = [self._read(self.inputs[index, i], patch) for i in range(self.num_inputs)]
+        if not self.co_transforms_first:
+            input_sample = [self.input_transform[i].transform(x) for i, x in enumerate(input_sample)]
+        if not self.has_target:
+            if self.co_transforms_first:
+                input_sample = [self.input_transform[i].transform(x) for i, x in enumerate(input_sample)]
+            return self.input_return_processor(input_sample)
+
+        target_sample = [self._read(self.targets[index, i], patch) for i in range(self.num_targets)]
+        if not self.co_transforms_first:
+            target_sample = [self.target_transform[i].transform(x) for i, x in enumerate(target_sample)]
+        for i in range(self.min_inputs_or_targets):
+            input_sample[i], target_sample[i] = self.co_transform[i].transform(input_sample[i], target_sample[i])
+        if self.co_transforms_first:
+            input_sample = [self.input_transform[i].transform(x) for i, x in enumerate(input_sample)]
+            target_sample = [self.target_transform[i].transform(x) for i, x in enumerate(target_sample)]
+
+        return self.input_return_processor(input_sample), self.target_return_processor(target_sample)
+
+    def get_batch(self, indices):
+        """
+        Read a whole batch at once. The patches coming from the same archive
+        are read with one (sorted) fancy indexing of the memory map, then the
+        transforms are applied sample by sample, except for the co-transforms
+        with a transform_batch method (e.g. transforms.RandomAffine), which
+        transform the whole batch at once.
+        """
+        if self.num_inputs != 1 or self.num_targets != 1:
+            return [np.stack(x, 0) for x in zip(*[self[i] for i in indices])]
+        indices = np.asarray(indices, dtype='int64')
+        patches = self.patches[indices]
+        inputs = self._read_batch(self.inputs[indices, 0], patches)
+        targets = self._read_batch(self.targets[indices, 0], patches)
+        if hasattr(self.co_transform[0], 'transform_batch'):
+            if not self.co_transforms_first:
+                inputs = np.stack([self.input_transform[0].transform(x) for x in inputs], 0)
+                targets = np.stack([self.target_transform[0].transform(y) for y in targets], 0)
+            inputs, targets = self.co_transform[0].transform_batch(inputs, targets)
+            if self.co_transforms_first:
+                inputs = np.stack([self.input_transform[0].transform(x) for x in inputs], 0)
+                targets = np.stack([self.target_transform[0].transform(y) for y in targets], 0)
+            return inputs, targets
+        input_samples = []
+        target_samples = []
+        for x, y in zip(inputs, targets):
+            if not self.co_transforms_first:
+                x = self.input_transform[0].transform(x)
+                y = self.target_transform[0].transform(y)
+            x, y = self.co_transform[0].transform(x, y)
+            if self.co_transforms_first:
+                x = self.input_transform[0].transform(x)
+                y = self.target_transform[0].transform(y)
+            input_samples.append(x)
+            target_samples.append(y)
+
+        return np.stack(input_samples, 0), np.stack(target_samples, 0)
+
+    def copy(self, df=None):
+        if df is None:
+            df = self.df
+
+        return PatchArchiveDataset(df,
+                                   input_cols=self.input_cols,
+                                   target_cols=self.target_cols,
+                                   index_col=self.index_col,
+                                   foreground_col=self.foreground_col,
+                                   input_transform=self.input_transform,
+                                   target_transform=self.target_transform,
+                                   co_transform=self.co_transform,
+                                   co_transforms_first=self.co_transforms_first,
+                                   base_path=self.base_path)
+
+    def __getstate__(self):
+        # memory maps are re-opened lazily by each worker process
+        state = self.__dict__.copy()
+        state['_archives'] = {}
+        return state
+
+
+class CachedPatchDataset(BaseDataset):
+
+    def __init__(self, dataset, max_memory=None, cache_dir=None, prefix='cached',
+                 chunk_size=1024):
+        """
+        Load all the patches of a PatchArchiveDataset once into two contiguous
+        arrays (inputs and targets, with the dtypes of the archives), to be
+        reused at every epoch without any file access. No transform is applied,
+        so this is meant for validation data.
+
+        Arguments
+        ---------
+        dataset : PatchArchiveDataset
+            dataset to cache
+
+        max_memory : integer (optional)
+            maximum number of bytes to keep in memory. If the arrays are
+            bigger, they are written to two .npy files in cache_dir and
+            memory-mapped instead
+
+        cache_dir : string (optional)
+            directory for the memory-mapped arrays
+
+        prefix : string
+            prefix of the memory-mapped files
+        """
+        if len(dataset) == 0:
+            raise ValueError('The dataset to cache is empty.')
+        indices = np.arange(len(dataset), dtype='int64')
+        first_input = dataset._read(dataset.inputs[0, 0], dataset.patches[0])
+        first_target = dataset._read(dataset.targets[0, 0], dataset.patches[0])
+        input_shape = (len(dataset),)+first_input.shape
+        target_shape = (len(dataset),)+first_target.shape
+        n_bytes = (np.prod(input_shape)*first_input.dtype.itemsize
+                   + np.prod(target_shape)*first_target.dtype.itemsize)
+        self.memory_mapped = max_memory is not None and n_bytes > max_memory
+        if self.memory_mapped:
+            if cache_dir is None:
+                raise ValueError('cache_dir must be provided to memory-map the patches.')
+            self.inputs = np.lib.format.open_memmap(
+                os.path.join(cache_dir, prefix+'_images.npy'), mode='w+',
+                dtype=first_input.dtype, shape=input_shape)
+            self.targets = np.lib.format.open_memmap(
+                os.path.join(cache_dir, prefix+'_masks.npy'), mode='w+',
+                dtype=first_target.dtype, shape=target_shape)
+        else:
+            self.inputs = np.empty(input_shape, dtype=first_input.dtype)
+            self.targets = np.empty(target_shape, dtype=first_target.dtype)
+        for n in range(0, len(dataset), chunk_size):
+            chunk = indices[n:n+chunk_size]
+            self.inputs[chunk[0]:chunk[-1]+1] = dataset._read_batch(
+                dataset.inputs[chunk, 0], dataset.patches[chunk])
+            self.targets[chunk[0]:chunk[-1]+1] = dataset._read_batch(
+                dataset.targets[chunk, 0], dataset.patches[chunk])
+        if self.memory_mapped:
+            self.inputs.flush()
+            self.targets.flush()
+        self.num_inputs = 1
+        self.num_targets = 1
+        self.has_target = True
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def __getitem__(self, index):
+        return self.inputs[index], self.targets[index]
+
+    def get_batch(self, indices):
+        """
+        Return a batch. Consecutive indices (e.g. sequential sampling) are
+        returned as views of the cached arrays, without copies.
+        """
+        indices = np.asarray(indices, dtype='int64')
+        if len(indices) and indices[-1] - indices[0] + 1 == len(indices) \
+                and np.all(np.diff(indices) == 1):
+            batch = slice(indices[0], indices[-1]+1)
+            return self.inputs[batch], self.targets[batch]
+        return self.inputs[indices], self.targets[indices]
+
+    def __getstate__(self):
+        # worker processes re-open the memory-mapped files instead of copying them
+        state = self.__dict__.copy()
+        if self.memory_mapped:
+            state['inputs'] = self.inputs.filename
+            state['targets'] = self.targets.filename
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.memory_mapped:
+            self.inputs = np.load(self.inputs, mmap_mode='r')
+            self.targets = np.load(self.targets, mmap_mode='r')
+
+
 def _find_classes(dir):
     classes = [d for d in os.listdir(dir) if os.path.isdir(os.path.join(dir, d))]
     classes.sort()
@@ -7,6 +7,7 @@ import nrrd
 import multiprocessing
 import collections
 import math
+import random
 import sys
 import traceback
 import threading
@@ -15,8 +16,10 @@ import scipy.misc
 if sys.version_info[0] == 2:
     import Queue as queue
     string_classes = basestring
+    container_abcs = collections
 else:
     import queue
+    import collections.abc as container_abcs
     string_classes = (str, bytes)
 
 
@@ -36,32 +39,7 @@ def load_data_2D(data_dir, data_type, data_list=[], array=None, mb=[], bs=None,
     patch_width = patch_size[0]
     patch_height = patch_size[1]
 
-    dx = img_size[0] if img_size[0] >= patch_width else patch_width
-    dy = img_size[1] if img_size[1] >= patch_height else patch_height
-    
-    if len(mb) < 2:
-        mb.append(dx//patch_width)
-
-    if len(mb) < 2:
-        mb.append(dy//patch_height)
-    
-    diffX = dx - patch_width if dx - patch_width != 0 else dx
-    diffY = dy - patch_height if dy - patch_height != 0 else dy
-
-    overlapX = diffX//(mb[0]-1) if not dx % patch_width and mb[0] > 1 else diffX//(mb[0])
-    overlapY = diffY//(mb[1]-1) if not dy % patch_height and mb[1] > 1 else diffY//(mb[1])
-    
-    indX = 0
-    xx = []
-    while indX+patch_width <= dx:
-        xx.append([indX, indX+patch_width])
-        indX = indX + overlapX
-    
-    indY = 0
-    yy = []
-    while indY+patch_height <= dy:
-        yy.append([indY, indY+patch_height])
-        indY = indY + overlapY
+    xx, yy = patch_grid(img_size, patch_size=patch_size, mb=mb)
 
     final_array = None
 
@@ -128,8 +106,225 @@ def load_data_2D(data_dir, data_type, data_list=[], array=None, mb=[], bs=None,
     return final_array, results_dict
 
 
-_use_shared_memory = False
-"""Whether to use shared memory in default_collate"""
+def patch_grid(img_size, patch_size=(96, 96), mb=None):
+    """Function to compute the (possibly overlapping) patch grid of a 2D image.
+    It returns the start and end indexes of the patches along x and y."""
+    patch_width = patch_size[0]
+    patch_height = patch_size[1]
+    mb = [] if mb is None else mb
+
+    dx = img_size[0] if img_size[0] >= patch_width else patch_width
+    dy = img_size[1] if img_size[1] >= patch_height else patch_height
+    
+    if len(mb) < 2:
+        mb.append(dx//patch_width)
+
+    if len(mb) < 2:
+        mb.append(dy//patch_height)
+    
+    diffX = dx - patch_width if dx - patch_width != 0 else dx
+    diffY = dy - patch_height if dy - patch_height != 0 else dy
+
+    overlapX = diffX//(mb[0]-1) if not dx % patch_width and mb[0] > 1 else diffX//(mb[0])
+    overlapY = diffY//(mb[1]-1) if not dy % patch_height and mb[1] > 1 else diffY//(mb[1])
+    
+    indX = 0
+    xx = []
+    while indX+patch_width <= dx:
+        xx.append([indX, indX+patch_width])
+        indX = indX + overlapX
+    
+    indY = 0
+    yy = []
+    while indY+patch_height <= dy:
+        yy.append([indY, indY+patch_height])
+        indY = indY + overlapY
+
+    return xx, yy
+
+
+def n_patches_3D(image_shape, patch_size=(96, 96)):
+    "Function to return the number of patches load_data_3D will extract from a volume"
+    xx, yy = patch_grid(image_shape[:2], patch_size=patch_size)
+    return len(xx)*len(yy)*int(image_shape[2])
+
+
+def load_data_3D(volume, patch_size=(96, 96), binarize=False, normalization=True,
+                 prediction=False, out=None, chunk_size=32, slice_ranges=None, kept=None):
+    """
+    Function to extract the 2D patches of all the axial slices of a volume
+    (X, Y, Z) at once. The patches, and their order, are the same obtained
+    calling load_data_2D on each slice (min-max normalization per slice,
+    zero padding of slices smaller than the patch), but the volume is
+    processed in chunks of chunk_size slices, normalized in float32 and
+    windowed with stride tricks. The patches are written directly into out,
+    a (N, patch_size[0], patch_size[1], 1) array (for example the memory map
+    of a patches.PatchArchive), which is allocated as float16 if None.
+    slice_ranges, if provided, is a (mins, maxs) tuple with the intensity range
+    of each slice used for the normalization (for volumes cropped from a
+    bigger image, which must be normalized as the whole slices).
+    kept, if provided, is a boolean array with one value per patch (same
+    order); only the patches where it is True are extracted, and out has
+    one row per kept patch.
+    """
+    patch_width = patch_size[0]
+    patch_height = patch_size[1]
+    img_size = volume.shape[:2]
+    n_slices = volume.shape[2]
+    xx, yy = patch_grid(img_size, patch_size=patch_size)
+    patches = len(xx)*len(yy)
+    step_x = xx[1][0] - xx[0][0] if len(xx) > 1 else 0
+    step_y = yy[1][0] - yy[0][0] if len(yy) > 1 else 0
+    delta_x = (patch_width - img_size[0]) if (img_size[0] < patch_width) else 0
+    delta_y = (patch_height - img_size[1]) if img_size[1] < patch_height else 0
+
+    n_out = n_slices*patches if kept is None else int(np.count_nonzero(kept))
+    if out is None:
+        out = np.empty((n_out, patch_width, patch_height, 1), dtype=np.float16)
+    if kept is None:
+        out_slices = out.reshape(n_slices, len(yy), len(xx), patch_width, patch_height)
+    else:
+        kept = np.asarray(kept, dtype=bool).reshape(n_slices, len(yy), len(xx))
+        out_patches = out.reshape(n_out, patch_width, patch_height)
+        position = 0
+
+    for z0 in range(0, n_slices, chunk_size):
+        z1 = min(z0+chunk_size, n_slices)
+        if kept is not None and not kept[z0:z1].any():
+            continue
+        # the chunk keeps the memory layout of the volume (Fortran order for
+        # arrays read with nrrd.read), the strided view takes care of the rest
+        chunk = volume[:, :, z0:z1]
+        if normalization:
+            chunk = chunk.astype(np.float32, order='K')
+            if slice_ranges is None:
+                mins = chunk.min(axis=(0, 1))
+                ranges = chunk.max(axis=(0, 1)) - mins
+            else:
+                mins = np.asarray(slice_ranges[0][z0:z1], dtype=np.float32)
+                ranges = np.asarray(slice_ranges[1][z0:z1], dtype=np.float32) - mins
+            # same as normalize(method='0-1'): constant slices are left unchanged
+            chunk -= np.where(ranges > 0, mins, 0)
+            chunk /= np.where(ranges > 0, ranges, 1)
+        if binarize:
+            chunk = chunk != 0
+        if delta_x or delta_y:
+            padded = np.zeros((img_size[0]+delta_x, img_size[1]+delta_y, z1-z0),
+                              dtype=chunk.dtype, order='F')
+            padded[delta_x:, delta_y:, :] = chunk
+            chunk = padded
+        strides = chunk.strides
+        windows = np.lib.stride_tricks.as_strided(
+            chunk, shape=(z1-z0, len(yy), len(xx), patch_width, patch_height),
+            strides=(strides[2], strides[1]*step_y, strides[0]*step_x, strides[0], strides[1]),
+            writeable=False)
+        if kept is None:
+            out_slices[z0:z1] = windows
+        else:
+            n_kept = int(np.count_nonzero(kept[z0:z1]))
+            out_patches[position:position+n_kept] = windows[kept[z0:z1]]
+            position += n_kept
+
+    results_dict = {}
+    if prediction:
+        results_dict[0] = {}
+        results_dict[0]['image_dim'] = img_size
+        results_dict[0]['indexes'] = [xx, yy]
+        results_dict[0]['deltas'] = [delta_x, delta_y]
+        results_dict[0]['patches'] = patches
+
+    return out, results_dict
+
+
+def patch_foreground(mask, patch_size=(96, 96), chunk_size=32):
+    """
+    Function to count the foreground (non zero) voxels of each patch that
+    load_data_3D would extract from the binary volume mask, in the same
+    order. The counts are computed from the summed area table of each slice,
+    so the patches are never created.
+    """
+    patch_width = patch_size[0]
+    patch_height = patch_size[1]
+    img_size = mask.shape[:2]
+    n_slices = mask.shape[2]
+    xx, yy = patch_grid(img_size, patch_size=patch_size)
+    delta_x = (patch_width - img_size[0]) if (img_size[0] < patch_width) else 0
+    delta_y = (patch_height - img_size[1]) if img_size[1] < patch_height else 0
+    x0 = np.asarray([i[0] for i in xx])[None, :]
+    x1 = np.asarray([i[1] for i in xx])[None, :]
+    y0 = np.asarray([j[0] for j in yy])[:, None]
+    y1 = np.asarray([j[1] for j in yy])[:, None]
+
+    counts = np.empty((n_slices, len(yy), len(xx)), dtype=np.int32)
+    for z0 in range(0, n_slices, chunk_size):
+        z1 = min(z0+chunk_size, n_slices)
+        # sat[x, y] is the number of foreground voxels in padded[:x, :y]
+        sat = np.zeros((img_size[0]+delta_x+1, img_size[1]+delta_y+1, z1-z0), dtype=np.int32)
+        sat[1+delta_x:, 1+delta_y:, :] = (mask[:, :, z0:z1] != 0).cumsum(0).cumsum(1)
+        counts[z0:z1] = (sat[x1, y1] - sat[x0, y1] - sat[x1, y0] + sat[x0, y0]).transpose(2, 0, 1)
+
+    return counts.ravel()
+
+
+def blending_weights(patch_size=(96, 96), method='mean'):
+    """Function to compute the weights used to blend overlapping patches.
+    method can be 'mean' (all the pixels have the same weight), 'gaussian'
+    (gaussian centred on the patch, sigma = 1/8 of the patch size) or
+    'linear' (weights decreasing linearly from the centre to the border)."""
+    if method == 'mean':
+        return np.ones(patch_size, dtype=np.float32)
+    weights = []
+    for size in patch_size:
+        coords = np.arange(size, dtype=np.float32) - (size-1)/2.
+        if method == 'gaussian':
+            sigma = size/8.
+            weights.append(np.exp(-coords**2/(2*sigma**2)))
+        elif method == 'linear':
+            weights.append(1 - np.abs(coords)/(size/2.))
+        else:
+            raise ValueError('Unknown blending method {}. Possible choices are '
+                             '"mean", "gaussian" and "linear".'.format(method))
+    weights = np.outer(weights[0], weights[1])
+
+    return (weights/weights.max()).astype(np.float32)
+
+
+def stitch_patches(patches_array, slices, dims, indexes, deltas, blending='mean',
+                   out=None, kept=None):
+    """
+    Function to stitch the 2D patches created by load_data_3D (or load_data_2D)
+    back into a (X, Y, Z) volume. The patches are summed in place into out
+    (allocated as float32 if None), weighted with blending_weights, and then
+    divided by the total weight of each pixel. Pixels not covered by any patch
+    are set to 0. If kept (boolean array with one value per patch) is provided,
+    patches_array contains only the kept patches and the others are zeros.
+    """
+    patches = len(indexes[0])*len(indexes[1])
+    if kept is not None:
+        all_patches = np.zeros((kept.size,)+patches_array.shape[1:], dtype=patches_array.dtype)
+        all_patches[kept] = patches_array
+        patches_array = all_patches
+    patch_size = patches_array.shape[1:3]
+    if out is None:
+        out = np.zeros((dims[0], dims[1], slices), dtype=np.float32)
+    else:
+        out[:] = 0
+    weights = blending_weights(patch_size, method=blending)[deltas[0]:, deltas[1]:]
+    weight_map = np.zeros(dims[:2], dtype=np.float32)
+    k = 0
+    for j in indexes[1]:
+        for i in indexes[0]:
+            patch = patches_array[k:slices*patches:patches, deltas[0]:, deltas[1]:]
+            if blending == 'mean':
+                out[i[0]:i[1], j[0]:j[1], :] += patch.transpose(1, 2, 0)
+            else:
+                out[i[0]:i[1], j[0]:j[1], :] += (patch*weights).transpose(1, 2, 0)
+            weight_map[i[0]:i[1], j[0]:j[1]] += weights
+            k += 1
+    covered = weight_map > 0
+    out[covered] /= weight_map[covered][:, None]
+
+    return out
 
 
 class ExceptionWrapper(object):
@@ -140,22 +335,47 @@ class ExceptionWrapper(object):
         self.exc_msg = "".join(traceback.format_exception(*exc_info))
 
 
-def _worker_loop(dataset, index_queue, data_queue, collate_fn):
-    global _use_shared_memory
-    _use_shared_memory = True
+def _load_batch(dataset, indices, collate_fn):
+    if hasattr(dataset, 'get_batch'):
+        return dataset.get_batch(indices)
+    return collate_fn([dataset[i] for i in indices])
+
+
+def _batch_fields(batch):
+    "Returns the list of arrays of a batch (a single array or a tuple/list of arrays)"
+    fields = [batch] if isinstance(batch, np.ndarray) else list(batch)
+    if not all(isinstance(x, np.ndarray) for x in fields):
+        raise TypeError('Batches must be numpy arrays or tuples/lists of numpy arrays '
+                        'to be loaded in shared memory.')
+    return fields
+
+
+def _slot_views(buffers, specs):
+    "Returns the numpy views of the shared memory buffers of one slot"
+    return [np.frombuffer(buffer, dtype=dtype).reshape(shape)
+            for buffer, (shape, dtype) in zip(buffers, specs)]
+
+
+def _worker_loop(dataset, index_queue, data_queue, collate_fn, slots, specs, seed):
+    # each worker has its own random states (numpy and random, both used by the
+    # transforms), otherwise forked workers would draw the same augmentations
+    np.random.seed(seed)
+    random.seed(seed)
+    views = [_slot_views(buffers, specs) for buffers in slots]
 
     while True:
         r = index_queue.get()
         if r is None:
-            data_queue.put(None)
             break
-        idx, batch_indices = r
+        idx, slot, batch_indices = r
         try:
-            samples = collate_fn([dataset[i] for i in batch_indices])
+            fields = _batch_fields(_load_batch(dataset, batch_indices, collate_fn))
+            for view, field in zip(views[slot], fields):
+                view[:len(field)] = field
         except Exception:
-            data_queue.put((idx, ExceptionWrapper(sys.exc_info())))
+            data_queue.put((idx, slot, ExceptionWrapper(sys.exc_info())))
         else:
-            data_queue.put((idx, samples))
+            data_queue.put((idx, slot, len(batch_indices)))
 
 
 def default_collate(batch):
@@ -168,14 +388,14 @@ def default_collate(batch):
             py_type = float if elem.dtype.name.startswith('float') else int
             return np.array(list(map(py_type, batch)))
     elif isinstance(batch[0], int):
-        return np.array(batch).astype('uint8')
+        return np.array(batch, dtype='int64')
     elif isinstance(batch[0], float):
         return np.array(batch).astype('float32')
     elif isinstance(batch[0], string_classes):
         return batch
-    elif isinstance(batch[0], collections.Mapping):
+    elif isinstance(batch[0], container_abcs.Mapping):
         return {key: default_collate([d[key] for d in batch]) for key in batch[0]}
-    elif isinstance(batch[0], collections.Sequence):
+    elif isinstance(batch[0], container_abcs.Sequence):
         transposed = zip(*batch)
         return [default_collate(samples) for samples in transposed]
 
@@ -184,7 +404,17 @@ def default_collate(batch):
 
 
 class DataLoaderIter(object):
-    "Iterates once over the DataLoader's dataset, as specified by the sampler"
+    """Iterates over the DataLoader's dataset, as specified by the sampler.
+
+    With num_workers > 0 the batches are loaded by a pool of worker processes
+    into a ring of preallocated shared memory slots: only the batch indices
+    and the slot numbers go through the queues, and the returned arrays are
+    views of the slots (no copy). A slot is refilled only after held_batches
+    more batches have been returned, so the consumer can keep that many
+    batches (e.g. in the Keras generator queue) before they are overwritten.
+    When sample_forever is True the sampler is restarted at the end of each
+    epoch without stopping the workers, so prefetching continues across epochs.
+    """
 
     def __init__(self, loader):
         self.loader = loader
@@ -193,32 +423,49 @@ class DataLoaderIter(object):
         self.collate_fn = loader.collate_fn
         self.sampler = loader.sampler
         self.num_workers = loader.num_workers
-        self.done_event = threading.Event()
+        self.epoch = 0
+        self.shutdown = False
+        self.workers = []
+        self.data_queue = None
 
-        self.samples_remaining = len(self.sampler)
+        # a sampler restored with load_state_dict resumes from its position
+        self.samples_remaining = len(self.sampler) - getattr(self.sampler, 'position', 0)
         self.sample_iter = iter(self.sampler)
 
         if self.num_workers > 0:
+            self.prefetch = loader.prefetch_batches or 2 * self.num_workers
+            n_slots = self.prefetch + loader.held_batches
+            # the shape of the slots is taken from one sample loaded here
+            sample = _batch_fields(_load_batch(self.dataset, [0], self.collate_fn))
+            self.specs = [((self.batch_size,)+x.shape[1:], x.dtype) for x in sample]
+            self.slots = [[multiprocessing.RawArray('b', int(np.prod(shape))*dtype.itemsize)
+                           for shape, dtype in self.specs] for _ in range(n_slots)]
+            self.views = [_slot_views(buffers, self.specs) for buffers in self.slots]
+            self.is_tuple = not isinstance(sample, np.ndarray) and len(sample) > 1
+            self.free_slots = collections.deque(range(n_slots))
+            self.returned_slots = collections.deque()
+
             self.index_queue = multiprocessing.SimpleQueue()
-            self.data_queue = multiprocessing.SimpleQueue()
+            self.data_queue = multiprocessing.Queue()
             self.batches_outstanding = 0
-            self.shutdown = False
             self.send_idx = 0
             self.rcvd_idx = 0
             self.reorder_dict = {}
 
+            seed = np.random.randint(2**31 - self.num_workers)
             self.workers = [
                 multiprocessing.Process(
                     target=_worker_loop,
-                    args=(self.dataset, self.index_queue, self.data_queue, self.collate_fn))
-                for _ in range(self.num_workers)]
+                    args=(self.dataset, self.index_queue, self.data_queue, self.collate_fn,
+                          self.slots, self.specs, seed + i))
+                for i in range(self.num_workers)]
 
             for w in self.workers:
                 w.daemon = True  # ensure that the worker exits on process exit
                 w.start()
 
             # prime the prefetch loop
-            for _ in range(2 * self.num_workers):
+            for _ in range(self.prefetch):
                 self._put_indices()
 
     def __len__(self):
@@ -226,43 +473,43 @@ class DataLoaderIter(object):
 
     def __next__(self):
         if self.num_workers == 0:  # same-process loading
-            if self.samples_remaining == 0:
-                if self.loader.sample_forever:
-                    self.__init__(self.loader)
-                else:
-                    raise StopIteration
-            indices = self._next_indices()
-            batch = self.collate_fn([self.dataset[i] for i in indices])
-            return batch
+            if not self._has_samples():
+                raise StopIteration
+            return _load_batch(self.dataset, self._next_indices(), self.collate_fn)
 
         # check if the next sample has already been generated
         if self.rcvd_idx in self.reorder_dict:
-            batch = self.reorder_dict.pop(self.rcvd_idx)
-            return self._process_next_batch(batch)
+            return self._process_next_batch(*self.reorder_dict.pop(self.rcvd_idx))
 
         if self.batches_outstanding == 0:
-            if self.loader.sample_forever:
-                self._shutdown_workers()
-                self.__init__(self.loader)
-            else:
-                self._shutdown_workers()
-                raise StopIteration
+            self._shutdown_workers()
+            raise StopIteration
 
         while True:
             assert (not self.shutdown and self.batches_outstanding > 0)
-            idx, batch = self.data_queue.get()
+            idx, slot, batch = self._get_data()
             self.batches_outstanding -= 1
             if idx != self.rcvd_idx:
                 # store out-of-order samples
-                self.reorder_dict[idx] = batch
+                self.reorder_dict[idx] = (slot, batch)
                 continue
-            return self._process_next_batch(batch)
+            return self._process_next_batch(slot, batch)
 
     next = __next__  # Python 2 compatibility
 
     def __iter__(self):
         return self
 
+    def _has_samples(self):
+        "Starts a new epoch if the sampler is exhausted and the loader samples forever"
+        if self.samples_remaining == 0 and self.loader.sample_forever:
+            self.epoch += 1
+            if hasattr(self.sampler, 'set_epoch'):
+                self.sampler.set_epoch(self.sampler.epoch + 1)
+            self.samples_remaining = len(self.sampler)
+            self.sample_iter = iter(self.sampler)
+        return self.samples_remaining > 0
+
     def _next_indices(self):
         batch_size = min(self.samples_remaining, self.batch_size)
         batch = [next(self.sample_iter) for _ in range(batch_size)]
@@ -270,18 +517,32 @@ class DataLoaderIter(object):
         return batch
 
     def _put_indices(self):
-        assert self.batches_outstanding < 2 * self.num_workers
-        if self.samples_remaining > 0:
-            self.index_queue.put((self.send_idx, self._next_indices()))
+        assert self.batches_outstanding < self.prefetch
+        if self.free_slots and self._has_samples():
+            slot = self.free_slots.popleft()
+            self.index_queue.put((self.send_idx, slot, self._next_indices()))
             self.batches_outstanding += 1
             self.send_idx += 1
 
-    def _process_next_batch(self, batch):
+    def _get_data(self):
+        while True:
+            try:
+                return self.data_queue.get(timeout=5)
+            except queue.Empty:
+                if any(not w.is_alive() for w in self.workers):
+                    self._shutdown_workers()
+                    raise RuntimeError('DataLoader worker exited unexpectedly.')
+
+    def _process_next_batch(self, slot, batch):
         self.rcvd_idx += 1
+        self.returned_slots.append(slot)
+        if len(self.returned_slots) > self.loader.held_batches:
+            self.free_slots.append(self.returned_slots.popleft())
         self._put_indices()
         if isinstance(batch, ExceptionWrapper):
             raise batch.exc_type(batch.exc_msg)
-        return batch
+        views = [view[:batch] for view in self.views[slot]]
+        return tuple(views) if self.is_tuple else views[0]
 
     def __getstate__(self):
         # TODO: add limited pickling support for sharing an iterator
@@ -292,16 +553,26 @@ class DataLoaderIter(object):
         raise NotImplementedError("DataLoaderIterator cannot be pickled")
 
     def _shutdown_workers(self):
-        if not self.shutdown:
+        # data_queue is None if __init__ failed before starting the workers
+        if not self.shutdown and self.data_queue is not None:
             self.shutdown = True
-            self.done_event.set()
             for _ in self.workers:
                 self.index_queue.put(None)
-
-    def __del__(self):
+            for w in self.workers:
+                w.join(timeout=5)
+                if w.is_alive():
+                    w.terminate()
+            self.data_queue.close()
+            self.data_queue.join_thread()
+
+    def close(self):
+        "Stops the worker processes"
         if self.num_workers > 0:
             self._shutdown_workers()
 
+    def __del__(self):
+        self.close()
+
 
 class Sampler(object):
     """Base class for all Samplers.
@@ -321,38 +592,158 @@ class Sampler(object):
         raise NotImplementedError
 
 
-class SequentialSampler(Sampler):
-    """Samples elements sequentially, always in the same order.
+class EpochSampler(Sampler):
+    """Base class of the samplers drawing num_samples int64 indices per epoch
+    out of data_samples elements. If num_samples is bigger than data_samples,
+    the data are passed more than once, each pass with its own order. The order
+    of each pass depends only on seed, epoch and pass number, so the indices are
+    generated one pass at a time (nothing is tiled) and the sampling can be
+    resumed from a saved state (see state_dict). The position counts the
+    indices already drawn, including the ones of prefetched batches.
 
-    Arguments:
-        data_source (Dataset): dataset to sample from
+    Subclasses have to provide the _order method, returning the indices of one
+    pass given a np.random.RandomState.
     """
 
-    def __init__(self, num_samples, data_samples=None):
-        self.num_samples = num_samples
-        self.data_samples = data_samples if data_samples is not None else num_samples
-        self.n_repeats = math.ceil(self.num_samples / self.data_samples)
+    def __init__(self, num_samples, data_samples=None, seed=None):
+        self.num_samples = int(num_samples)
+        self.data_samples = int(data_samples) if data_samples is not None else self.num_samples
+        self.seed = int(np.random.randint(2**31)) if seed is None else int(seed)
+        self.epoch = 0
+        self.position = 0
 
-    def __iter__(self):
-        return iter(np.tile(np.arange(self.data_samples,dtype='uint8'),self.n_repeats))
+    def _order(self, rng):
+        raise NotImplementedError
 
-    def __len__(self):
-        return self.num_samples
+    def set_epoch(self, epoch):
+        self.epoch = int(epoch)
+        self.position = 0
 
-class RandomSampler(Sampler):
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'position': self.position}
 
-    def __init__(self, num_samples, data_samples):
-        self.num_samples = num_samples
-        self.data_samples = data_samples if data_samples is not None else num_samples
-        self.n_repeats = math.ceil(self.num_samples / self.data_samples)
+    def load_state_dict(self, state):
+        self.seed = int(state['seed'])
+        self.epoch = int(state['epoch'])
+        self.position = int(state['position'])
 
     def __iter__(self):
-        return iter(np.tile(np.random.permutation(self.data_samples).astype('uint8'),self.n_repeats))
+        while self.position < self.num_samples:
+            n_pass, offset = divmod(self.position, self.data_samples)
+            rng = np.random.RandomState([self.seed, self.epoch, n_pass])
+            order = np.asarray(self._order(rng), dtype='int64')
+            stop = min(self.data_samples, self.num_samples - n_pass*self.data_samples)
+            for index in order[offset:stop]:
+                self.position += 1
+                yield index
 
     def __len__(self):
         return self.num_samples
 
 
+class SequentialSampler(EpochSampler):
+    """Samples elements sequentially, always in the same order.
+
+    Arguments:
+        num_samples (int): number of indices per epoch
+        data_samples (int): number of elements in the dataset
+    """
+
+    def _order(self, rng):
+        return np.arange(self.data_samples, dtype='int64')
+
+
+class RandomSampler(EpochSampler):
+    """Samples elements in a new random order at every pass.
+
+    Arguments:
+        num_samples (int): number of indices per epoch
+        data_samples (int): number of elements in the dataset
+        seed (int, optional): seed of the random orders
+    """
+
+    def _order(self, rng):
+        return rng.permutation(self.data_samples)
+
+
+class SubjectSampler(EpochSampler):
+    """Samples the elements grouped by subject: the subjects are visited in a
+    random order and the elements of each subject are shuffled. Consecutive
+    batches read from the same patch archive.
+
+    Arguments:
+        groups (array): subject (e.g. patch archive) of each element
+        num_samples (int, optional): number of indices per epoch (default:
+            the number of elements)
+        seed (int, optional): seed of the random orders
+    """
+
+    def __init__(self, groups, num_samples=None, seed=None):
+        _, self.groups = np.unique(np.asarray(groups), return_inverse=True)
+        self.groups = self.groups.astype('int64')
+        self.n_groups = int(self.groups.max()) + 1 if self.groups.size else 0
+        num_samples = len(self.groups) if num_samples is None else num_samples
+        EpochSampler.__init__(self, num_samples, len(self.groups), seed=seed)
+
+    def _order(self, rng):
+        group_rank = np.empty(self.n_groups, dtype='int64')
+        group_rank[rng.permutation(self.n_groups)] = np.arange(self.n_groups)
+        return np.lexsort((rng.random_sample(self.data_samples), group_rank[self.groups]))
+
+
+class WeightedRandomSampler(EpochSampler):
+    """Samples num_samples elements (with replacement) with probabilities
+    proportional to weights.
+
+    Arguments:
+        weights (array): weight of each element
+        num_samples (int, optional): number of indices per epoch (default:
+            the number of elements)
+        seed (int, optional): seed of the random draws
+    """
+
+    def __init__(self, weights, num_samples=None, seed=None):
+        weights = np.asarray(weights, dtype='float64')
+        if weights.ndim != 1 or np.any(weights < 0) or not weights.sum() > 0:
+            raise ValueError('weights must be a 1D array of non negative values, '
+                             'not all zeros.')
+        self.probabilities = weights / weights.sum()
+        num_samples = len(weights) if num_samples is None else num_samples
+        # one pass draws the whole epoch
+        EpochSampler.__init__(self, num_samples, num_samples, seed=seed)
+
+    def _order(self, rng):
+        return rng.choice(len(self.probabilities), size=self.num_samples, p=self.probabilities)
+
+
+class ForegroundSampler(EpochSampler):
+    """Samples, at every epoch, all the elements with foreground and a random
+    subset of the background elements (different at every epoch), so that
+    there are ratio foreground elements for each background one. Elements with
+    unknown foreground (negative values) are always sampled.
+
+    Arguments:
+        foreground (array): foreground fraction of each element
+        ratio (float): number of foreground elements per background element
+        seed (int, optional): seed of the random draws
+    """
+
+    def __init__(self, foreground, ratio=1., seed=None):
+        if ratio <= 0:
+            raise ValueError('The foreground/background ratio must be positive.')
+        foreground = np.asarray(foreground, dtype='float64')
+        self.foreground = np.flatnonzero(foreground != 0).astype('int64')
+        self.background = np.flatnonzero(foreground == 0).astype('int64')
+        self.n_background = min(len(self.background),
+                                int(round(len(self.foreground)/float(ratio))))
+        n_samples = len(self.foreground) + self.n_background
+        EpochSampler.__init__(self, n_samples, n_samples, seed=seed)
+
+    def _order(self, rng):
+        background = rng.choice(self.background, self.n_background, replace=False)
+        return rng.permutation(np.concatenate([self.foreground, background]))
+
+
 class DataLoader(object):
     """
     Data loader. Combines a dataset and a sampler, and provides
@@ -365,24 +756,35 @@ class DataLoader(object):
         shuffle (bool, optional): set to ``True`` to have the data reshuffled
             at every epoch (default: False).
         sampler (Sampler, optional): defines the strategy to draw samples from
-            the dataset. If specified, the ``shuffle`` argument is ignored.
+            the dataset (e.g. SubjectSampler or WeightedRandomSampler). If
+            specified, the ``shuffle`` argument is ignored.
         num_workers (int, optional): how many subprocesses to use for data
             loading. 0 means that the data will be loaded in the main process
             (default: 0)
         collate_fn (callable, optional)
+        prefetch_batches (int, optional): how many batches the workers load
+            in advance (default: 2 * num_workers)
+        held_batches (int, optional): how many returned batches the consumer
+            can keep before their shared memory is reused. It must be at least
+            the size of the queue of the consumer, e.g. max_queue_size + 1 for
+            Keras fit_generator (default: 1)
     """
 
     def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, 
                  num_workers=0, sample_forever=True, collate_fn=default_collate,
-                 max_epoch=500):
+                 max_epoch=500, prefetch_batches=None, held_batches=1):
         self.dataset = dataset
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.collate_fn = collate_fn
         self.sample_forever = sample_forever
+        self.prefetch_batches = prefetch_batches
+        self.held_batches = held_batches
 
         num_samples = len(dataset) #if num_workers == 0 else int(len(dataset)*max_epoch)
-        if shuffle:
+        if sampler is not None:
+            self.sampler = sampler
+        elif shuffle:
             self.sampler = RandomSampler(num_samples, len(dataset))
         else:
             self.sampler = SequentialSampler(num_samples, len(dataset))
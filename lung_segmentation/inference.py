@@ -1,21 +1,87 @@
 "Class to run lung segmentation inference"
 import logging
 import os
+from collections import OrderedDict
 from pathlib import Path
 import nrrd
 import pickle
 import numpy as np
-from skimage.transform import resize
 from lung_segmentation.utils import (binarization, dice_calculation,
-                                     violin_box_plot, run_cluster_correction,
-                                     run_hd, batch_processing, resize_image)
+                                     violin_box_plot, correct_clusters,
+                                     run_hd, batch_processing, resize_image,
+                                     roi_bounding_box)
 from lung_segmentation.models import unet_lung
 from lung_segmentation.base import LungSegmentationBase
+from lung_segmentation.generators import stitch_patches, load_data_3D
+from lung_segmentation.resampling import resample, new_image_shape
 
 
 LOGGER = logging.getLogger('lungs_segmentation')
 
 
+class EnsemblePredictor():
+    """Class to predict the mean of all the cross-validation folds. The models
+    are loaded once (and cached, so they can be reused by following predictors
+    with the same weights) and each batch is run through every fold back to
+    back, keeping only a running sum instead of one prediction per fold. The
+    cache keeps at most max_models models, the least recently used are dropped
+    first (they stay in memory as long as a predictor uses them)."""
+    _models = OrderedDict()
+    max_models = 20
+
+    def __init__(self, weights, input_size=(96, 96, 1), batch_size=32):
+
+        self.weights = list(weights)
+        self.batch_size = batch_size
+        self.models = [self.load_model(w, input_size) for w in self.weights]
+
+    @classmethod
+    def from_weights(cls, weights, whole_slice=False):
+        """Function to create the predictor for patches or, if whole_slice is True,
+        for whole slices (flexible input size, sides multiple of 16)"""
+        if whole_slice:
+            return cls(weights, input_size=(None, None, 1), batch_size=4)
+        return cls(weights)
+
+    @classmethod
+    def load_model(cls, weight, input_size=(96, 96, 1)):
+        "Function to load one fold model, or to return it from the cache"
+        key = (os.path.abspath(weight), tuple(input_size))
+        if key in cls._models:
+            cls._models.move_to_end(key)
+            return cls._models[key]
+        LOGGER.info('Loading weights {}.'.format(weight))
+        model = unet_lung(input_size=input_size)
+        model.load_weights(weight)
+        cls._models[key] = model
+        while len(cls._models) > cls.max_models:
+            cls._models.popitem(last=False)
+        return model
+
+    @classmethod
+    def clear_cache(cls, clear_session=False):
+        """Function to empty the model cache. If clear_session is True, the Keras
+        session is cleared as well, which frees the memory of all the models
+        loaded so far (the existing predictors cannot be used anymore)"""
+        cls._models.clear()
+        if clear_session:
+            from keras import backend as K
+            K.clear_session()
+
+    def predict(self, images, out=None):
+        "Function to predict the ensemble, one batch at a time"
+        if out is None:
+            out = np.empty(images.shape[:-1]+(1,), dtype=np.float16)
+        for n in range(0, images.shape[0], self.batch_size):
+            batch = np.asarray(images[n:n+self.batch_size])
+            running_sum = self.models[0].predict_on_batch(batch).astype(np.float32)
+            for model in self.models[1:]:
+                running_sum += model.predict_on_batch(batch)
+            out[n:n+self.batch_size] = running_sum/len(self.models)
+
+        return out
+
+
 class LungSegmentationInference(LungSegmentationBase):
     "Class to run the lung segmentation inference and evaluation."
     def get_data(self, root_path=''):
@@ -48,33 +114,84 @@ class LungSegmentationInference(LungSegmentationBase):
 
         self.work_dir = os.path.join(str(self.work_dir), 'inference')
 
-    def create_tensors(self, patch_size=(96, 96), save2npy=False):
+    def create_tensors(self, patch_size=(96, 96), save2npy=False, whole_slice=False,
+                       skip_background=False):
         "Function to create the tensors for the prediction"
-        return LungSegmentationBase.create_tensors(self, patch_size=patch_size, save2npy=save2npy)
+        return LungSegmentationBase.create_tensors(self, patch_size=patch_size, save2npy=save2npy,
+                                                   whole_slice=whole_slice,
+                                                   skip_background=skip_background)
 
-    def run_inference(self, weights):
-        "Function to run the CNN inference"
-        test_set = np.asarray(self.image_tensor)
-        predictions = []
-        LOGGER.info('Segmentation inference started.')
-        model = unet_lung()
-        for i, weight in enumerate(weights):
-            LOGGER.info('Segmentation inference fold {}.'.format(i+1))
-            model.load_weights(weight)
-            predictions.append(model.predict(test_set))
+    def localize_lungs(self, weights, roi_spacing=(3, 3, 3), margin=20, images=None):
+        """Function to run a coarse pass of the network on the images resampled to
+        roi_spacing and to store in image_info the bounding box of the lungs,
+        enlarged by margin (in mm). create_tensors and save_inference will then
+        process only the slices and patches within the box. Only the first fold
+        is used for the coarse pass"""
+        if isinstance(weights, EnsemblePredictor):
+            weights = weights.weights
+        predictor = EnsemblePredictor(weights[:1])
+        if images is None:
+            images = self.preprocessed_images
+        for image in images:
+            volume, hd = nrrd.read(image)
+            spacing = np.abs(np.diag(np.asarray(hd['space directions'], dtype=float)))
+            coarse_shape = new_image_shape(volume.shape, spacing, roi_spacing)
+            coarse = resample(volume, coarse_shape, order=1)
+            patches, info = load_data_3D(coarse, prediction=True)
+            info = info[0]
+            coarse_prediction = stitch_patches(predictor.predict(patches)[:, :, :, 0],
+                                               coarse_shape[2], info['image_dim'],
+                                               info['indexes'], info['deltas'])
+            box = roi_bounding_box(coarse_prediction, th=0.5)
+            if box is None:
+                LOGGER.warning('No lung found in the coarse prediction of {}. The '
+                               'whole image will be segmented.'.format(image))
+                self.image_info[image].pop('roi', None)
+                continue
+            lung = coarse_prediction > 0.5
+            inside = lung[tuple(slice(start, stop) for start, stop in box)]
+            n_outside = np.count_nonzero(lung) - np.count_nonzero(inside)
+            if n_outside:
+                LOGGER.warning('{0:.1f}% of the lung voxels of the coarse prediction of {1} '
+                               'are outside the box and will not be segmented.'.format(
+                                   100*n_outside/np.count_nonzero(lung), image))
+            roi = []
+            for (start, stop), n_full, n_coarse, sp in zip(box, volume.shape,
+                                                           coarse_shape, spacing):
+                scale = n_full/n_coarse
+                pad = int(np.ceil(margin/sp))
+                roi.append((max(0, int(np.floor(start*scale))-pad),
+                            min(n_full, int(np.ceil(stop*scale))+pad)))
+            self.image_info[image]['roi'] = roi
+            self.image_info[image]['resampled_size'] = volume.shape
+            LOGGER.info('Lungs of {0} localized in the box {1} ({2:.1f}% of the image).'
+                        .format(image, roi, 100*np.prod([y-x for x, y in roi])
+                                / np.prod(volume.shape)))
 
-        predictions = np.asarray(predictions, dtype=np.float16)
-        self.prediction = np.mean(predictions, axis=0)
+    def run_inference(self, weights, whole_slice=False):
+        """Function to run the CNN inference. weights can be a list of weight
+        files (one per fold) or an EnsemblePredictor. If whole_slice is True, the
+        network is built with a flexible input size to predict whole slices"""
+        if isinstance(weights, EnsemblePredictor):
+            predictor = weights
+        else:
+            predictor = EnsemblePredictor.from_weights(weights, whole_slice=whole_slice)
+        LOGGER.info('Segmentation inference started.')
+        self.prediction = predictor.predict(self.image_tensor)
 
-    def save_inference(self, min_extent=10000, cluster_correction=True):
-        "Function to save the segmented masks"
+    def save_inference(self, min_extent=10000, cluster_correction=True, blending='mean',
+                       images=None):
+        """Function to save the segmented masks. images are the images in the
+        current prediction, in the same order (default all the images in image_info)"""
         prediction = self.prediction
         if cluster_correction:
             binarize = False
         else:
             binarize = True
+        if images is None:
+            images = list(self.image_info)
         z0 = 0
-        for i, image in enumerate(self.image_info):
+        for i, image in enumerate(images):
             try:
                 patches = self.image_info[image]['patches']
                 slices = self.image_info[image]['slices']
@@ -82,49 +199,75 @@ class LungSegmentationInference(LungSegmentationBase):
                 indexes = self.image_info[image]['indexes']
                 deltas = self.image_info[image]['deltas']
                 original_image_dim = self.image_info[image]['orig_size']
-                im = prediction[z0:z0+(slices*patches), :, :, 0]
+                kept = self.image_info[image].get('kept')
+                n_patches = slices*patches if kept is None else int(np.count_nonzero(kept))
+                im = prediction[z0:z0+n_patches, :, :, 0]
                 final_prediction = self.inference_reshaping(
                     im, patches, slices, resampled_image_dim, indexes, deltas,
-                    original_image_dim, binarize=binarize)
+                    original_image_dim, binarize=binarize, blending=blending, kept=kept,
+                    roi=self.image_info[image].get('roi'),
+                    resampled_size=self.image_info[image].get('resampled_size'))
                 outname = image.split('_resampled')[0]+'_lung_segmented.nrrd'
-                reference = image.split('_resampled')[0]+'.nrrd'
-                _, hd = nrrd.read(reference)
-                nrrd.write(outname, final_prediction, header=hd)
+                hd = self.image_info[image].get('reference_header')
+                if hd is None:
+                    reference = image.split('_resampled')[0]+'.nrrd'
+                    hd = nrrd.read_header(reference)
                 if cluster_correction:
-                    outname = run_cluster_correction(outname, 0.2, min_extent)
+                    final_prediction = correct_clusters(
+                        final_prediction, th=0.2, min_extent=min_extent, image=outname)
+                    outname = outname.split('.nrrd')[0]+'_corrected.nrrd'
+                nrrd.write(outname, final_prediction, header=hd)
                 self.predicted_images.append(outname)
-                z0 = z0+(slices*patches)
+                z0 = z0+n_patches
             except:
                 continue
 
+    def run_streaming_inference(self, weights, min_extent=10000, cluster_correction=True,
+                                blending='mean', window=1, patch_size=(96, 96),
+                                whole_slice=False, roi_spacing=None, roi_margin=20,
+                                skip_background=False):
+        """Function to run tensor creation, prediction, stitching and saving on
+        window pre-processed images at a time, so that the memory needed does
+        not depend on the number of subjects. If roi_spacing is provided, the
+        lungs are localized first (see localize_lungs)"""
+        if isinstance(weights, EnsemblePredictor):
+            predictor = weights
+        else:
+            predictor = EnsemblePredictor.from_weights(weights, whole_slice=whole_slice)
+        all_images = self.preprocessed_images
+        LOGGER.info('Streaming inference over {0} images, {1} at a time.'
+                    .format(len(all_images), window))
+        try:
+            for n in range(0, len(all_images), window):
+                self.preprocessed_images = all_images[n:n+window]
+                if roi_spacing is not None:
+                    self.localize_lungs(predictor, roi_spacing=roi_spacing, margin=roi_margin)
+                self.create_tensors(patch_size=patch_size, whole_slice=whole_slice,
+                                    skip_background=skip_background)
+                self.run_inference(predictor)
+                self.save_inference(min_extent=min_extent, cluster_correction=cluster_correction,
+                                    blending=blending, images=self.preprocessed_images)
+                self.image_tensor = None
+                self.prediction = None
+        finally:
+            self.preprocessed_images = all_images
+
     @staticmethod
     def inference_reshaping(generated_images, patches, slices,
                             dims, indexes, deltas, original_size,
-                            binarize=False):
-        "Function to reshape the predictions"
-        if patches > 1:
-            sl = 0
-            final_image = np.zeros((slices, dims[0], dims[1], patches),
-                                   dtype=np.float32)-2
-            for n in range(0, generated_images.shape[0], patches):
-                k = 0
-                for j in indexes[1]:
-                    for i in indexes[0]:
-                        final_image[sl, i[0]:i[1], j[0]:j[1], k] = (
-                            generated_images[n+k, deltas[0]:, deltas[1]:])
-                        k += 1
-                sl = sl + 1
-            final_image[final_image==-2] = np.nan
-            final_image = np.nanmean(final_image, axis=-1)
-            final_image[np.isnan(final_image)] = 0
-        else:
-            final_image = generated_images[:, deltas[0]:, deltas[1]:]
-
-        final_image = np.swapaxes(final_image, 0, 2)
-        final_image = np.swapaxes(final_image, 0, 1)
+                            binarize=False, blending='mean', roi=None, resampled_size=None,
+                            kept=None):
+        """Function to reshape the predictions. If roi is provided, the stitched
+        prediction is placed within an empty image of size resampled_size. kept
+        are the patches that were predicted (the others are set to 0)"""
+        final_image = stitch_patches(generated_images, slices, dims, indexes, deltas,
+                                     blending=blending, kept=kept)
+        if roi is not None:
+            full_image = np.zeros(resampled_size, dtype=final_image.dtype)
+            full_image[tuple(slice(start, stop) for start, stop in roi)] = final_image
+            final_image = full_image
         if final_image.shape != original_size:
-            final_image = resize(final_image.astype(np.float64), original_size, order=0,
-                                 mode='edge', cval=0, anti_aliasing=False)
+            final_image = resample(final_image, original_size, order=0)
         if binarize:
             final_image = binarization(final_image)
 
@@ -0,0 +1,85 @@
+"""
+Functions and classes to store the 2D patches created from the 3D images
+in memory-mappable archives (one archive per image, with an offset index)
+instead of writing one .npy file per patch.
+"""
+import os
+import csv
+import numpy as np
+
+
+ARCHIVE_EXT = '_patches.npy'
+INDEX_EXT = '_patches.csv'
+INDEX_COLUMNS = ['images', 'masks', 'patch', 'foreground']
+
+
+class PatchArchive():
+    """Class to write all the patches of one image (and of the corresponding
+    mask, if any) into one chunk on disk. Each archive is a standard .npy file,
+    so it can be opened with np.load(..., mmap_mode='r'), and it comes with an
+    index file with one row per patch (image archive, mask archive, offset and
+    fraction of foreground voxels in the mask patch, -1 if there is no mask).
+    Images are stored as float16 and binary masks as uint8 by default.
+    """
+    def __init__(self, basename, n_patches, patch_size=(96, 96), mask_basename=None,
+                 dtype=np.float16, mask_dtype=np.uint8):
+
+        n_patches = int(n_patches)
+        shape = (n_patches, int(patch_size[0]), int(patch_size[1]), 1)
+        self.n_patches = n_patches
+        self.index = basename+INDEX_EXT
+        self.image_archive = basename+ARCHIVE_EXT
+        self.images = np.lib.format.open_memmap(self.image_archive, mode='w+',
+                                                dtype=dtype, shape=shape)
+        if mask_basename is not None:
+            self.mask_archive = mask_basename+ARCHIVE_EXT
+            self.masks = np.lib.format.open_memmap(self.mask_archive, mode='w+',
+                                                   dtype=mask_dtype, shape=shape)
+        else:
+            self.mask_archive = ''
+            self.masks = None
+
+    def close(self, foreground=None):
+        """Function to flush the archives and write the offset index. foreground is
+        the fraction of foreground voxels of each mask patch; if None, it is
+        computed from the mask archive"""
+        self.images.flush()
+        if self.masks is not None:
+            self.masks.flush()
+            if foreground is None:
+                foreground = (np.count_nonzero(self.masks.reshape(self.n_patches, -1), axis=1)
+                              / float(np.prod(self.masks.shape[1:])))
+        else:
+            foreground = -np.ones(self.n_patches)
+        with open(self.index, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(INDEX_COLUMNS)
+            for n in range(self.n_patches):
+                writer.writerow([self.image_archive, self.mask_archive, n,
+                                 '{:.6f}'.format(foreground[n])])
+        self.images = None
+        self.masks = None
+
+        return self.index
+
+
+def find_patch_indexes(directory):
+    "Function to find all the archive index files within directory"
+    indexes = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(INDEX_EXT):
+                indexes.append(os.path.join(root, name))
+
+    return sorted(indexes)
+
+
+def read_patch_index(index):
+    """Function to read one index file and return its rows as (image, mask, patch,
+    foreground) tuples. foreground is -1 for the indexes written without it"""
+    with open(index, 'r') as f:
+        reader = csv.reader(f)
+        next(reader)
+        rows = [(x[0], x[1], int(x[2]), float(x[3]) if len(x) > 3 else -1.) for x in reader]
+
+    return rows
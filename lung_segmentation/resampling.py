@@ -0,0 +1,194 @@
+"""
+Separable resampling of 3D volumes. The volume is interpolated one axis at a
+time (z, then x, then y) with float32 arithmetic, in chunks of output slices
+processed by a pool of threads, and the result is returned with the same
+dtype as the input. The sampling grid is the same one used by
+skimage.transform.resize (pixel centres aligned, edge values repeated).
+Higher orders (2 to 5) are not separable convolutions: they are delegated to
+skimage.transform.resize, so order=3 is still the cubic B-spline.
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from skimage.transform import resize
+
+
+ORDERS = {0: 'nearest', 1: 'linear'}
+SPLINE_ORDERS = (2, 3, 4, 5)
+
+
+def new_image_shape(shape, spacing, new_spacing):
+    "Function to compute the shape of a volume after resampling to new_spacing"
+    return tuple(max(1, int(round(s*sp/nsp))) for s, sp, nsp in zip(shape, spacing, new_spacing))
+
+
+def interpolation_taps(n_in, n_out, order=1):
+    """
+    Function to compute the input indexes and weights used to interpolate
+    each output sample along one axis.
+
+    Parameters
+    ----------
+    n_in : int
+        number of input samples
+    n_out : int
+        number of output samples
+    order : int
+        0 (nearest neighbour) or 1 (linear)
+
+    Returns
+    -------
+    indexes : np.ndarray
+        (n_out, taps) array of input indexes, clipped to the input size
+    weights : np.ndarray
+        (n_out, taps) float32 array of weights
+    """
+    coords = n_in/n_out*(np.arange(n_out)+0.5)-0.5
+    if order == 0:
+        indexes = np.floor(coords+0.5)[:, None]
+        weights = np.ones((n_out, 1))
+    elif order == 1:
+        start = np.floor(coords)
+        dist = coords-start
+        indexes = start[:, None]+np.arange(2)
+        weights = np.stack([1-dist, dist], axis=1)
+    else:
+        raise ValueError('Interpolation order {0} not supported. Possible choices are {1}.'
+                         .format(order, list(ORDERS)))
+    indexes = np.clip(indexes, 0, n_in-1).astype(np.intp)
+
+    return indexes, weights.astype(np.float32)
+
+
+class Resampler():
+    """Class to resample 3D volumes. The scratch buffers used by the worker
+    threads are kept between calls, so resampling many volumes of similar
+    size does not allocate new temporaries every time. Each calling thread
+    has its own buffers, so one Resampler can be used by concurrent threads."""
+    def __init__(self, n_threads=4, chunk_size=8):
+
+        self.n_threads = n_threads
+        self.chunk_size = chunk_size
+        self._local = threading.local()
+
+    def _get_buffers(self, size):
+        "Function to return one float32 scratch buffer per thread, with at least size elements"
+        if not hasattr(self._local, 'buffers'):
+            self._local.buffers = []
+        buffers = self._local.buffers
+        while len(buffers) < self.n_threads:
+            buffers.append(np.empty(0, dtype=np.float32))
+        for i, buffer in enumerate(buffers):
+            if buffer.size < size:
+                buffers[i] = np.empty(size, dtype=np.float32)
+        free = queue.Queue()
+        for buffer in buffers[:self.n_threads]:
+            free.put(buffer)
+        return free
+
+    def _resample_spline(self, image, new_shape, order, out):
+        "Function to resample image with the spline interpolation of skimage.transform.resize"
+        resized = resize(image.astype(np.float64), new_shape, order=order, mode='edge',
+                         cval=0, anti_aliasing=False)
+        if np.issubdtype(out.dtype, np.integer):
+            np.clip(np.rint(resized, out=resized), image.min(), image.max(), out=resized)
+        out[:] = resized
+        return out
+
+    def resample(self, image, new_shape, order=0, out=None):
+        """Function to resample image to new_shape. The output has the same
+        dtype as image (integer outputs are rounded and clipped to the input range).
+        order can be 0 (nearest neighbour) or 1 (linear), computed here, or 2 to 5
+        (splines of skimage.transform.resize, e.g. 3 for the cubic B-spline)"""
+        new_shape = tuple(int(x) for x in new_shape)
+        if out is None:
+            out = np.empty(new_shape, dtype=image.dtype, order='F')
+        if tuple(image.shape) == new_shape:
+            out[:] = image
+            return out
+        if order in SPLINE_ORDERS:
+            return self._resample_spline(image, new_shape, order, out)
+        taps = [interpolation_taps(n_in, n_out, order=order)
+                for n_in, n_out in zip(image.shape, new_shape)]
+        chunks = [(z0, min(z0+self.chunk_size, new_shape[2]))
+                  for z0 in range(0, new_shape[2], self.chunk_size)]
+
+        if order == 0:
+            def run(chunk):
+                z0, z1 = chunk
+                out[:, :, z0:z1] = image[np.ix_(taps[0][0][:, 0], taps[1][0][:, 0],
+                                                taps[2][0][z0:z1, 0])]
+        else:
+            in_x, in_y, _ = image.shape
+            out_x, out_y, _ = new_shape
+            zc = self.chunk_size
+            sizes = [in_x*in_y*zc]*2+[out_x*in_y*zc]*2+[out_x*out_y*zc]*2
+            offsets = np.cumsum([0]+sizes)
+            free = self._get_buffers(offsets[-1])
+            if np.issubdtype(out.dtype, np.integer):
+                low, high = image.min(), image.max()
+            else:
+                low, high = None, None
+
+            def view(buffer, n, shape):
+                return buffer[offsets[n]:offsets[n]+int(np.prod(shape))].reshape(shape)
+
+            def run(chunk):
+                z0, z1 = chunk
+                buffer = free.get()
+                try:
+                    # along z, straight from the input volume
+                    shape = (in_x, in_y, z1-z0)
+                    acc, tmp = view(buffer, 0, shape), view(buffer, 1, shape)
+                    indexes, weights = taps[2][0][z0:z1], taps[2][1][z0:z1]
+                    np.multiply(image[:, :, indexes[:, 0]], weights[:, 0], out=acc)
+                    for j in range(1, indexes.shape[1]):
+                        np.multiply(image[:, :, indexes[:, j]], weights[:, j], out=tmp)
+                        acc += tmp
+                    # along x
+                    shape = (out_x, in_y, z1-z0)
+                    src = acc
+                    acc, tmp = view(buffer, 2, shape), view(buffer, 3, shape)
+                    indexes, weights = taps[0]
+                    np.take(src, indexes[:, 0], axis=0, out=acc, mode='clip')
+                    acc *= weights[:, 0, None, None]
+                    for j in range(1, indexes.shape[1]):
+                        np.take(src, indexes[:, j], axis=0, out=tmp, mode='clip')
+                        tmp *= weights[:, j, None, None]
+                        acc += tmp
+                    # along y
+                    shape = (out_x, out_y, z1-z0)
+                    src = acc
+                    acc, tmp = view(buffer, 4, shape), view(buffer, 5, shape)
+                    indexes, weights = taps[1]
+                    np.take(src, indexes[:, 0], axis=1, out=acc, mode='clip')
+                    acc *= weights[None, :, 0, None]
+                    for j in range(1, indexes.shape[1]):
+                        np.take(src, indexes[:, j], axis=1, out=tmp, mode='clip')
+                        tmp *= weights[None, :, j, None]
+                        acc += tmp
+                    if low is not None:
+                        np.clip(acc, low, high, out=acc)
+                    if np.issubdtype(out.dtype, np.integer):
+                        np.rint(acc, out=acc)
+                    out[:, :, z0:z1] = acc
+                finally:
+                    free.put(buffer)
+
+        if self.n_threads > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+                list(executor.map(run, chunks))
+        else:
+            for chunk in chunks:
+                run(chunk)
+
+        return out
+
+
+_RESAMPLER = Resampler()
+
+
+def resample(image, new_shape, order=0, out=None):
+    "Function to resample image to new_shape with the module-level Resampler"
+    return _RESAMPLER.resample(image, new_shape, order=order, out=out)
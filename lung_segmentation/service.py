@@ -0,0 +1,205 @@
+"""
+Long-running segmentation service. The fold models of each configuration
+are loaded once and kept in memory, and the segmentation requests (NRRD
+images or DICOM folders) received over localhost HTTP are queued and
+processed one at a time by a single worker thread (the same thread that
+loaded the models, as required by Keras).
+"""
+import os
+import json
+import logging
+import queue
+import tempfile
+import threading
+import traceback
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from lung_segmentation.inference import (LungSegmentationInference, IndividualInference,
+                                         EnsemblePredictor)
+from lung_segmentation.configuration import STANDARD_CONFIG, HIGH_RES_CONFIG, HUMAN_CONFIG
+
+
+LOGGER = logging.getLogger('lungs_segmentation')
+CONFIGS = {'standard': STANDARD_CONFIG, 'high_res': HIGH_RES_CONFIG, 'human': HUMAN_CONFIG}
+DEFAULT_PORT = 8765
+
+
+class SegmentationJob():
+    "Class to hold one segmentation request until the worker has processed it"
+    def __init__(self, input_path, config='standard', work_dir=None):
+
+        self.input_path = input_path
+        self.config = config
+        self.work_dir = work_dir
+        self.masks = []
+        self.error = None
+        self.done = threading.Event()
+
+
+class SegmentationService():
+    """Class to keep the models of one or more configurations in memory and
+    to segment the queued requests. weights is a dictionary with the
+    configuration names (see CONFIGS) as keys and the lists of fold weights
+    as values."""
+    def __init__(self, weights, work_dir, conversion_method='mitk', whole_slice=False,
+                 skip_background=False):
+
+        for config in weights:
+            if config not in CONFIGS:
+                raise ValueError('Unknown configuration {0}. Possible choices are {1}.'
+                                 .format(config, list(CONFIGS)))
+        self.weights = weights
+        self.work_dir = work_dir
+        self.conversion_method = conversion_method
+        self.whole_slice = whole_slice
+        self.skip_background = skip_background
+        self.predictors = {}
+        self.jobs = queue.Queue()
+        self.n_processed = 0
+        self.ready = threading.Event()
+        self.error = None
+        self._worker = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Function to start the worker thread and wait for the models to be loaded.
+        The exception raised while loading them, if any, is raised here"""
+        self._worker.start()
+        self.ready.wait()
+        if self.error is not None:
+            self._worker.join()
+            raise self.error
+
+    def stop(self):
+        """Function to stop the worker thread once the queued requests are done and
+        to release the models"""
+        self.jobs.put(None)
+        self._worker.join()
+
+    def submit(self, input_path, config='standard', work_dir=None):
+        """Function to queue one request. Wait on job.done to get the result. work_dir,
+        if provided, must be empty or not exist yet, so that no file of a previous
+        request can be picked up"""
+        if config not in self.predictors and config not in self.weights:
+            raise ValueError('No weights loaded for configuration {}.'.format(config))
+        if work_dir is not None and os.path.isdir(work_dir) and os.listdir(work_dir):
+            raise ValueError('The working directory {} is not empty.'.format(work_dir))
+        job = SegmentationJob(input_path, config=config, work_dir=work_dir)
+        self.jobs.put(job)
+        return job
+
+    def _run(self):
+        try:
+            for config, weights in self.weights.items():
+                LOGGER.info('Loading {0} models for the {1} configuration.'
+                            .format(len(weights), config))
+                self.predictors[config] = EnsemblePredictor.from_weights(
+                    weights, whole_slice=self.whole_slice)
+        except Exception as e:
+            LOGGER.error('The models could not be loaded.')
+            self.error = e
+            return
+        finally:
+            self.ready.set()
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                job.masks = self.segment(job)
+            except Exception:
+                LOGGER.error('Segmentation of {} failed.'.format(job.input_path))
+                job.error = traceback.format_exc()
+            self.n_processed += 1
+            job.done.set()
+        # the models are released by the thread that loaded them
+        self.predictors = {}
+        EnsemblePredictor.clear_cache(clear_session=True)
+
+    def segment(self, job):
+        "Function to run the whole inference pipeline for one request"
+        config = CONFIGS[job.config]
+        work_dir = job.work_dir
+        if work_dir is None:
+            # new directory for each request, also across restarts of the service
+            if not os.path.isdir(self.work_dir):
+                os.makedirs(self.work_dir)
+            work_dir = tempfile.mkdtemp(prefix='request_{}_'.format(self.n_processed+1),
+                                        dir=self.work_dir)
+        LOGGER.info('Segmenting {0} with the {1} configuration. Working directory: {2}.'
+                    .format(job.input_path, job.config, work_dir))
+        if os.path.isdir(job.input_path):
+            inference = LungSegmentationInference(job.input_path, work_dir,
+                                                  deep_check=config['dicom_check'])
+            inference.testing = True
+            inference.predicted_images = []
+            inference.dcm_folders = [job.input_path]
+            inference.preprocessing(new_spacing=config['spacing'], accurate_naming=False,
+                                    conversion_method=self.conversion_method)
+        else:
+            inference = IndividualInference(job.input_path, work_dir)
+            inference.get_data()
+            inference.preprocessing(new_spacing=config['spacing'])
+        inference.run_streaming_inference(self.predictors[job.config],
+                                          cluster_correction=config['cluster_correction'],
+                                          min_extent=config['min_extent'],
+                                          whole_slice=self.whole_slice,
+                                          roi_spacing=config['roi_spacing'],
+                                          roi_margin=config['roi_margin'],
+                                          skip_background=self.skip_background)
+
+        return inference.predicted_images
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """Class to handle the HTTP requests. POST /segment with a JSON body
+    {"input": path, "config": name, "work_dir": path} queues a request and
+    answers, once it is done, with {"masks": [...]} or {"error": message}.
+    GET /status returns the loaded configurations and the queue length."""
+    def _reply(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self._reply(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+        service = self.server.service
+        self._reply(200, {'configs': sorted(service.predictors),
+                          'queued': service.jobs.qsize(),
+                          'processed': service.n_processed})
+
+    def do_POST(self):
+        if self.path != '/segment':
+            self._reply(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            job = self.server.service.submit(os.path.abspath(request['input']),
+                                             config=request.get('config', 'standard'),
+                                             work_dir=request.get('work_dir'))
+        except (ValueError, KeyError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        job.done.wait()
+        if job.error is not None:
+            self._reply(500, {'error': job.error})
+        else:
+            self._reply(200, {'masks': job.masks})
+
+    def log_message(self, format, *args):
+        LOGGER.debug('%s - %s', self.address_string(), format % args)
+
+
+class SegmentationServer(ThreadingMixIn, HTTPServer):
+    "Class to accept concurrent connections, the requests are then queued by the service"
+    daemon_threads = True
+
+    def __init__(self, service, host='127.0.0.1', port=DEFAULT_PORT):
+
+        HTTPServer.__init__(self, (host, port), ServiceRequestHandler)
+        self.service = service
@@ -12,15 +12,18 @@ from lung_segmentation.models import unet_lung
 from lung_segmentation.utils import batch_processing
 from lung_segmentation.base import LungSegmentationBase
 from lung_segmentation.loss import dice_coefficient, loss_dice_coefficient_error, combined_loss
-from lung_segmentation.dataloader import CSVDataset
+from lung_segmentation.dataloader import PatchArchiveDataset, CachedPatchDataset
+from lung_segmentation.patches import find_patch_indexes, read_patch_index, ARCHIVE_EXT
 from lung_segmentation import transforms as tx
-from lung_segmentation.generators import DataLoader
+from lung_segmentation.generators import (DataLoader, SequentialSampler, RandomSampler,
+                                          SubjectSampler, ForegroundSampler)
 from sklearn.model_selection import KFold
 import numpy as np
 import glob
 
 
 LOGGER = logging.getLogger('lungs_segmentation')
+SAMPLERS = {'sequential': SequentialSampler, 'random': RandomSampler, 'subject': SubjectSampler}
 
 
 class LungSegmentationTraining(LungSegmentationBase):
@@ -86,27 +89,32 @@ class LungSegmentationTraining(LungSegmentationBase):
                 masks = []
                 for root, _, files in os.walk(directory):
                     for name in files:
-                        if name.endswith('.npy') and 'Raw_data' in name and 'patch' in name:
+                        if (not name.endswith('.npy') or '_patch' not in name
+                                or name.endswith(ARCHIVE_EXT)):
+                            continue
+                        if 'Raw_data' in name:
                             data.append(os.path.join(root, name))
-                        elif name.endswith('.npy') and 'Raw_data' not in name and 'patch' in name:
+                        else:
                             masks.append(os.path.join(root, name))
+                # legacy datasets, with one .npy file per patch, have no offset
+                # and no foreground fraction
+                rows = [(x, y, -1, -1.) for x, y in zip(sorted(data), sorted(masks))]
+                for index in find_patch_indexes(directory):
+                    rows = rows + read_patch_index(index)
 
-                data = sorted(data)
-                masks = sorted(masks)
-
-                x_train, x_test, y_train, y_test = train_test_split(
-                    data, masks, test_size=test_percentage, random_state=42)
+                x_train, x_test = train_test_split(
+                    rows, test_size=test_percentage, random_state=42)
 
                 self.x_train = self.x_train + x_train
                 self.x_test = self.x_test + x_test
-                self.y_train = self.y_train + y_train
-                self.y_test = self.y_test + y_test
 
-            images = self.x_train + self.x_test
-            masks = self.y_train + self.y_test
+            rows = self.x_train + self.x_test
             data_dict = {}
-            data_dict['images'] = images
-            data_dict['masks'] = masks
+            data_dict['images'] = [x[0] for x in rows]
+            data_dict['masks'] = [x[1] for x in rows]
+            data_dict['patch'] = [x[2] for x in rows]
+            data_dict['foreground'] = [x[3] for x in rows]
+            images = data_dict['images']
             if fold > 1:
                 kf = KFold(n_splits=fold)
                 fold_number = 0
@@ -133,8 +141,23 @@ class LungSegmentationTraining(LungSegmentationBase):
 
     def run_training(self, n_epochs=100, training_bs=50, validation_bs=50,
                      lr_0=2e-4, training_steps=None, validation_steps=None,
-                     weight_name=None, data_augmentation=True, keep_training=False):
-        "Function to run training with data augmentation"
+                     weight_name=None, data_augmentation=True, keep_training=False,
+                     num_workers=0, sampling='sequential', foreground_ratio=None,
+                     validation_memory=None):
+        """Function to run training with data augmentation. With num_workers > 0 the
+        batches are loaded (and augmented) by num_workers processes. sampling is the
+        order of the training patches: 'sequential' (as in the CSV file), 'random'
+        (new order every epoch) or 'subject' (subjects in random order, patches of
+        each subject shuffled). If foreground_ratio is provided, every epoch uses all
+        the training patches containing lung and a random subset of the background
+        ones, with foreground_ratio lung patches per background patch (this
+        replaces sampling). The validation patches are read once, without augmentation,
+        and kept in memory; if they need more than validation_memory bytes they are
+        memory-mapped from the working directory instead"""
+        if sampling not in SAMPLERS:
+            raise ValueError('Unknown sampling {0}. Possible choices are {1}.'
+                             .format(sampling, list(SAMPLERS)))
+        max_queue_size = 10
         for n_fold, csv_file in enumerate(self.csv_file):
             LOGGER.info('Running training for fold {}'.format(n_fold+1))
             if data_augmentation:
@@ -149,34 +172,41 @@ class LungSegmentationTraining(LungSegmentationBase):
             else:
                 co_tx = None
 
-            dataset = CSVDataset(filepath=csv_file,
-                                 base_path='',
-                                 input_cols=['images'],
-                                 target_cols=['masks'],
-                                 co_transform=co_tx)
+            dataset = PatchArchiveDataset(filepath=csv_file,
+                                          base_path='',
+                                          input_cols=['images'],
+                                          target_cols=['masks'],
+                                          co_transform=co_tx)
 
             val_data, train_data = dataset.split_by_column('train-test')
+            val_data = CachedPatchDataset(val_data, max_memory=validation_memory,
+                                          cache_dir=self.work_dir,
+                                          prefix='validation_fold{}'.format(n_fold+1))
+            LOGGER.info('{0} validation patches cached ({1}).'.format(
+                len(val_data), 'memory-mapped' if val_data.memory_mapped else 'in memory'))
 
-            if training_steps is None:
-                training_steps = math.ceil(len(train_data)/training_bs)
-                validation_steps = math.ceil(len(val_data)/validation_bs)
+            if foreground_ratio is not None and train_data.foreground is None:
+                raise ValueError('{} has no foreground column, the foreground sampling '
+                                 'needs the data split to be run again.'.format(csv_file))
+            if foreground_ratio is not None:
+                sampler = ForegroundSampler(train_data.foreground, ratio=foreground_ratio,
+                                            seed=42+n_fold)
+                LOGGER.info('{0} out of {1} training patches will be used at every epoch.'
+                            .format(len(sampler), len(train_data)))
+            elif sampling == 'subject':
+                sampler = SubjectSampler(train_data.inputs[:, 0], seed=42+n_fold)
             else:
-                training_steps = training_steps
-                validation_steps = validation_steps
+                sampler = SAMPLERS[sampling](len(train_data), len(train_data), seed=42+n_fold)
 
-            train_loader = DataLoader(train_data, batch_size=training_bs, shuffle=False)
-            val_loader = DataLoader(val_data, batch_size=validation_bs, shuffle=False)
-            if weight_name is None:
-                weight_name = os.path.join(
-                    self.work_dir, 'double_feat_per_layer_BCE_augmented_fold{}.h5'.format(n_fold+1))
+            # the epoch length depends on the fold (e.g. with the foreground sampling)
+            fold_training_steps = training_steps
+            if fold_training_steps is None:
+                fold_training_steps = math.ceil(len(sampler)/training_bs)
+            fold_validation_steps = validation_steps
+            if fold_validation_steps is None:
+                fold_validation_steps = math.ceil(len(val_data)/validation_bs)
 
-            # create model
             initial_epoch = 0
-            if self.transfer_learning or keep_training:
-                model = unet_lung(pretrained_weights=weight_name)
-            else:
-                model = unet_lung()
-
             if keep_training:
                 try:
                     with open(os.path.join(self.work_dir, 'training_history_fold{}.p'
@@ -187,6 +217,32 @@ class LungSegmentationTraining(LungSegmentationBase):
                 except FileNotFoundError:
                     LOGGER.info('No training history found. The training will start from epoch 1')
 
+            # when the training is resumed, the sampler restarts from the first
+            # batch not seen yet
+            batches_per_epoch = math.ceil(len(sampler)/training_bs)
+            epoch, n_batch = divmod(initial_epoch*fold_training_steps, batches_per_epoch)
+            sampler.load_state_dict({'seed': sampler.seed, 'epoch': epoch,
+                                     'position': n_batch*training_bs})
+            # the batches returned by the loaders are views of shared memory, they
+            # must not be overwritten while they wait in the Keras queue
+            train_loader = DataLoader(train_data, batch_size=training_bs, sampler=sampler,
+                                      num_workers=num_workers,
+                                      held_batches=max_queue_size+2)
+            # the cached validation batches are slices of the cache, no workers needed
+            val_loader = DataLoader(val_data, batch_size=validation_bs, shuffle=False)
+            # the worker processes are started before the model is created
+            train_iter = iter(train_loader)
+            val_iter = iter(val_loader)
+            if weight_name is None:
+                weight_name = os.path.join(
+                    self.work_dir, 'double_feat_per_layer_BCE_augmented_fold{}.h5'.format(n_fold+1))
+
+            # create model
+            if self.transfer_learning or keep_training:
+                model = unet_lung(pretrained_weights=weight_name)
+            else:
+                model = unet_lung()
+
             if self.transfer_learning:
                 weight_name_0 = weight_name
                 for layer in model.layers[:25]:
@@ -202,15 +258,19 @@ class LungSegmentationTraining(LungSegmentationBase):
                                               save_best_only=True),
                          cbks.ReduceLROnPlateau(monitor='val_loss', factor=0.1)]
 
-            history = model.fit_generator(
-                generator=iter(train_loader),
-                steps_per_epoch=training_steps,
-                epochs=n_epochs, verbose=1, callbacks=callbacks,
-                shuffle=True,
-                validation_data=iter(val_loader),
-                validation_steps=validation_steps,
-                class_weight=None, max_queue_size=10,
-                workers=1, use_multiprocessing=False, initial_epoch=initial_epoch)
+            try:
+                history = model.fit_generator(
+                    generator=train_iter,
+                    steps_per_epoch=fold_training_steps,
+                    epochs=n_epochs, verbose=1, callbacks=callbacks,
+                    shuffle=True,
+                    validation_data=val_iter,
+                    validation_steps=fold_validation_steps,
+                    class_weight=None, max_queue_size=max_queue_size,
+                    workers=1, use_multiprocessing=False, initial_epoch=initial_epoch)
+            finally:
+                train_iter.close()
+                val_iter.close()
             if keep_training:
                 for key_val in past_hist.keys():
                     history.history[key_val] =  past_hist[key_val] + history.history[key_val]
@@ -3,8 +3,8 @@ import random
 import math
 import numpy as np
 import scipy.ndimage as ndi
+from concurrent.futures import ThreadPoolExecutor
 from sklearn import preprocessing as pp
-from keras.utils.np_utils import to_categorical
 
 class Compose(object):
 
@@ -32,6 +32,23 @@ class Compose(object):
                 X, y = tx.transform(X, y)
             return X, y
 
+    def transform_batch(self, X, y=None):
+        """Transform a whole batch (N, ...). The transforms without a transform_batch
+        method are applied sample by sample"""
+        for tx in self.transforms:
+            if hasattr(tx, 'transform_batch'):
+                if y is None:
+                    X = tx.transform_batch(X)
+                else:
+                    X, y = tx.transform_batch(X, y)
+            elif y is None:
+                X = np.stack([tx.transform(x) for x in X], 0)
+            else:
+                X, y = [np.stack(z, 0) for z in zip(*[tx.transform(a, b) for a, b in zip(X, y)])]
+        if y is None:
+            return X
+        return X, y
+
     def get_params(self):
         p_list_dict = []
         for tx in self.transforms:
@@ -120,6 +137,8 @@ class OneHot(object):
         """
         Assumes channel dim is last dimension
         """
+        # keras is imported only here, the other transforms do not need it
+        from keras.utils.np_utils import to_categorical
         xshape = list(X.swapaxes(0, -1).shape[:-1])
         xx = to_categorical(X.swapaxes(0, -1))
         xx = xx.reshape(xshape+[xx.shape[-1]])
@@ -162,7 +181,10 @@ def transform_matrix_offset_center(matrix, x, y):
     transform_matrix = np.dot(np.dot(offset_matrix, matrix), reset_matrix)
     return transform_matrix
 
-def apply_transform(x, transform, fill_mode='nearest', fill_value=0., channel_axis=2):
+def apply_transform(x, transform, fill_mode='nearest', fill_value=0., channel_axis=2,
+                    output=None):
+    """Warp x with the (nearest neighbour) affine transform. If output is
+    provided (same shape as x), the result is written into it with its dtype"""
     if isinstance(fill_value, str):
         if fill_value == 'min':
             fill_value = x.min()
@@ -179,11 +201,20 @@ def apply_transform(x, transform, fill_mode='nearest', fill_value=0., channel_ax
         is_4d = False
 
     x = np.rollaxis(x, channel_axis, 0)
-    x = x.astype('float32')
+    if output is None or x.dtype == np.float16:
+        x = x.astype('float32')
 
     transform = transform_matrix_offset_center(transform, x.shape[0], x.shape[1])
     final_affine_matrix = transform[:2, :2]
     final_offset = transform[:2, 2]
+    if output is not None:
+        output = output[..., 0] if is_4d else output
+        output = np.rollaxis(output, channel_axis, 0)
+        for x_channel, out_channel in zip(x, output):
+            ndi.interpolation.affine_transform(x_channel, final_affine_matrix, final_offset,
+                                               output=out_channel, order=0, mode=fill_mode,
+                                               cval=fill_value)
+        return output
     channel_images = [ndi.interpolation.affine_transform(x_channel, 
         final_affine_matrix, final_offset, order=0, mode=fill_mode, 
         cval=fill_value) for x_channel in x]
@@ -286,6 +317,44 @@ class RandomAffine(object):
         self.turn_off_frequency = turn_off_frequency
         self.frequency_counter = 0
 
+    def sample_matrices(self, n, shape):
+        """Sample the affine matrices of n samples with the given shape at once.
+        Every turn_off_frequency samples the identity is returned, as in transform"""
+        matrices = np.tile(np.eye(3), (n, 1, 1))
+        for tform in self.transforms:
+            matrices = np.matmul(matrices, tform.matrices(n, shape))
+        if self.turn_off_frequency is not None:
+            counter = self.frequency_counter + np.arange(n)
+            matrices[counter % self.turn_off_frequency == 0] = np.eye(3)
+        self.frequency_counter += n
+        return matrices
+
+    def transform_batch(self, X, y=None, n_threads=4):
+        """Transform a whole batch X (and the corresponding targets y) with shape
+        (N, H, W, C). The matrices are sampled at once and the samples are warped
+        by a pool of threads directly into the output arrays. X is returned as
+        float32 and y as uint8 (nearest neighbour, as for the single samples)"""
+        matrices = self.sample_matrices(len(X), X.shape[1:])
+        X_out = np.empty(X.shape, dtype='float32')
+        y_out = None if y is None else np.empty(y.shape, dtype='uint8')
+
+        def warp(n):
+            apply_transform(X[n], matrices[n], fill_mode=self.fill_mode,
+                            fill_value=self.fill_value, output=X_out[n])
+            if y is not None:
+                apply_transform(y[n], matrices[n], fill_mode=self.target_fill_mode,
+                                fill_value=self.target_fill_value, output=y_out[n])
+
+        if n_threads > 1 and len(X) > 1:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                list(executor.map(warp, range(len(X))))
+        else:
+            for n in range(len(X)):
+                warp(n)
+        if y is not None:
+            return X_out, y_out
+        return X_out
+
     def transform(self, X, y=None):
         if (self.turn_off_frequency is not None) and (self.frequency_counter % self.turn_off_frequency == 0):
             tform_matrix = np.eye(3)
@@ -309,6 +378,8 @@ class RandomAffine(object):
             return X
 
     def get_params(self):
+        """Return the parameters of the last sampled transform (the last sample of
+        the batch after transform_batch)"""
         vals = {}
         if self.rtx is not None:
             vals['rotation'] = self.rtx._degree
@@ -414,6 +485,19 @@ class RandomRotate(object):
         self.target_fill_value = target_fill_value
         self.lazy = lazy
 
+    def matrices(self, n, shape):
+        degree = np.random.uniform(self.rotation_range[0], self.rotation_range[1], n)
+        if n:
+            # as in transform, get_params returns the last sampled parameters
+            self._degree = degree[-1]
+        theta = np.pi / 180 * degree
+        matrices = np.tile(np.eye(3), (n, 1, 1))
+        matrices[:, 0, 0] = np.cos(theta)
+        matrices[:, 0, 1] = -np.sin(theta)
+        matrices[:, 1, 0] = np.sin(theta)
+        matrices[:, 1, 1] = np.cos(theta)
+        return matrices
+
     def transform(self, X, y=None):
         degree = random.uniform(self.rotation_range[0], self.rotation_range[1])
         self._degree = degree
@@ -481,6 +565,16 @@ class RandomTranslate(object):
         self.target_fill_value = target_fill_value
         self.lazy = lazy
 
+    def matrices(self, n, shape):
+        matrices = np.tile(np.eye(3), (n, 1, 1))
+        if self.height_range > 0:
+            matrices[:, 0, 2] = np.random.uniform(-self.height_range, self.height_range, n) * shape[0]
+        if self.width_range > 0:
+            matrices[:, 1, 2] = np.random.uniform(-self.width_range, self.width_range, n) * shape[1]
+        if n:
+            self._txty = (matrices[-1, 0, 2], matrices[-1, 1, 2])
+        return matrices
+
     def transform(self, X, y=None):
         # height shift
         if self.height_range > 0:
@@ -545,6 +639,16 @@ class RandomShear(object):
         self.target_fill_value = target_fill_value
         self.lazy = lazy
 
+    def matrices(self, n, shape):
+        shear = np.random.uniform(self.shear_range[0], self.shear_range[1], n)
+        if n:
+            self._shear = shear[-1]
+        shear = np.pi / 180 * shear
+        matrices = np.tile(np.eye(3), (n, 1, 1))
+        matrices[:, 0, 1] = -np.sin(shear)
+        matrices[:, 1, 1] = np.cos(shear)
+        return matrices
+
     def transform(self, X, y=None):
         shear = random.uniform(self.shear_range[0], self.shear_range[1])
         self._shear = shear
@@ -608,6 +712,14 @@ class RandomZoom(object):
         self.target_fill_value = target_fill_value
         self.lazy = lazy
 
+    def matrices(self, n, shape):
+        matrices = np.tile(np.eye(3), (n, 1, 1))
+        matrices[:, 0, 0] = np.random.uniform(self.zoom_range[0], self.zoom_range[1], n)
+        matrices[:, 1, 1] = np.random.uniform(self.zoom_range[0], self.zoom_range[1], n)
+        if n:
+            self._zoom = (matrices[-1, 0, 0], matrices[-1, 1, 1])
+        return matrices
+
     def transform(self, X, y=None):
         zx = random.uniform(self.zoom_range[0], self.zoom_range[1])
         zy = random.uniform(self.zoom_range[0], self.zoom_range[1])
@@ -8,7 +8,8 @@ import logging
 import shutil
 import glob
 from operator import itemgetter
-import collections
+import collections.abc
+from concurrent.futures import ThreadPoolExecutor
 import pydicom
 import nrrd
 import numpy as np
@@ -16,22 +17,96 @@ import nibabel as nib
 #import PySimpleGUI as sg
 from skimage.filters.thresholding import threshold_otsu
 from skimage.transform import resize
+from scipy import ndimage
 import pandas as pd
 import matplotlib.pyplot as plot
 import matplotlib.cbook as cbook
 import subprocess as sp
 from medpy.metric.binary import hd, hd95, dc
+from lung_segmentation.resampling import resample, new_image_shape
 from lung_segmentation.configuration import (
         STANDARD_CONFIG, HIGH_RES_CONFIG, HUMAN_CONFIG, CUSTOM_CONFIG)
 
 
+LOGGER = logging.getLogger('lungs_segmentation')
 ALLOWED_EXT = ['.xlsx', '.csv']
+DICOM_MANIFEST = 'dicom_series.txt'
 ILLEGAL_CHARACTERS = ['/', '(', ')', '[', ']', '{', '}', ' ', '-']
 
 
+DICOM_INDEX_TAGS = ['SeriesNumber', 'SeriesTime', 'InstanceNumber',
+                    'SeriesDescription', 'AcquisitionDate']
+DICOM_STAT_COLUMNS = ['mtime', 'size']
+
+
+def file_stat(path):
+    "Function to return the modification time (ns) and size of a file, as strings"
+    try:
+        stat = os.stat(str(path))
+    except OSError:
+        return ['', '']
+    return [str(stat.st_mtime_ns), str(stat.st_size)]
+
+
+def read_dicom_header(dcm):
+    "Function to read the DICOM header only (pixel data are not parsed)"
+    try:
+        return pydicom.dcmread(str(dcm), stop_before_pixels=True)
+    except Exception:
+        return None
+
+
+class DicomIndex(object):
+    """Class to build an in-memory table (path, series, time, instance, description,
+    date) of a list of DICOM files. Each header is parsed only once, without pixel
+    data, using a pool of threads. If index_file is provided, the table is saved
+    there and re-used the next time, as long as it refers to the same files with
+    the same modification time and size (otherwise it is built again)."""
+    def __init__(self, dicoms, n_threads=8, index_file=None):
+
+        self.dcms = [str(x) for x in dicoms]
+        self.headers = {}
+        self.table = None
+        if index_file is not None and os.path.isfile(index_file):
+            table = pd.read_csv(index_file, dtype=str, keep_default_na=False)
+            if (set(DICOM_STAT_COLUMNS).issubset(table.columns)
+                    and sorted(table['path']) == sorted(self.dcms)):
+                table = table.set_index('path', drop=False).loc[self.dcms]
+                if table[DICOM_STAT_COLUMNS].values.tolist() == [file_stat(x) for x in self.dcms]:
+                    self.table = table
+        if self.table is None:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                headers = list(executor.map(read_dicom_header, self.dcms))
+            rows = []
+            for dcm, header in zip(self.dcms, headers):
+                self.headers[dcm] = header
+                rows.append([dcm]+[str(getattr(header, t, '')) for t in DICOM_INDEX_TAGS]
+                            +file_stat(dcm))
+            self.table = pd.DataFrame(rows, columns=['path']+DICOM_INDEX_TAGS+DICOM_STAT_COLUMNS)
+            self.table = self.table.set_index('path', drop=False)
+            if index_file is not None:
+                self.table.to_csv(index_file, index=False)
+
+    def select(self, tag, value):
+        "Function to return the paths of all the files with tag equal to value"
+        return list(self.table['path'][self.table[tag] == str(value)])
+
+    def values(self, tag, dicoms=None):
+        "Function to return the value of tag for each of the files in dicoms"
+        dicoms = self.dcms if dicoms is None else [str(x) for x in dicoms]
+        return list(self.table.loc[dicoms, tag])
+
+    def header(self, dcm):
+        "Function to return the (pixel-free) header of one file"
+        dcm = str(dcm)
+        if dcm not in self.headers:
+            self.headers[dcm] = read_dicom_header(dcm)
+        return self.headers[dcm]
+
+
 class DicomInfo(object):
     
-    def __init__(self, dicoms):
+    def __init__(self, dicoms, index=None):
 
         if type(dicoms) == list:
             self.dcms = dicoms
@@ -45,6 +120,7 @@ class DicomInfo(object):
                 self.dcms = dcms
         else:
             self.dcms = [dicoms]
+        self.index = index
 
     def get_tag(self, tag):
         
@@ -52,13 +128,23 @@ class DicomInfo(object):
 
         if type(tag) is not list:
             tag = [tag]
+        if self.index is None:
+            self.index = DicomIndex(self.dcms)
         for t in tag:
             values = []
+            if t in DICOM_INDEX_TAGS:
+                for dcm, val in zip(self.dcms, self.index.values(t, self.dcms)):
+                    if val:
+                        values.append(val)
+                    else:
+                        print ('{} seems to do not have the requested DICOM field ({})'.format(dcm, t))
+                tags[t] = list(set(values))
+                continue
             for dcm in self.dcms:
-                header = pydicom.read_file(str(dcm))
+                header = self.index.header(dcm)
                 try:
                     val = header.data_element(t).value
-                    if isinstance(val, collections.Iterable) and type(val) is not str:
+                    if isinstance(val, collections.abc.Iterable) and type(val) is not str:
                         val = tuple(val)
                     else:
                         val = str(val)
@@ -214,7 +300,7 @@ def batch_processing(input_data, key_col1='subjects', key_col2='masks', root='')
         return raw_data, masks
 
 
-def dicom_check(raw_data, temp_dir, deep_check=True):
+def dicom_check(raw_data, temp_dir, deep_check=True, save_index=True, staging='hardlink'):
     """Function to arrange the mouse lung data into a proper structure.
     In particular, this function will look into each raw_data folder searching for
     the data with H50s in the series description field in the DICOM header. Then,
@@ -224,6 +310,16 @@ def dicom_check(raw_data, temp_dir, deep_check=True):
     ----------
     raw_data : str
         path to the raw data folder 
+    temp_dir : str
+        folder where the selected DICOM series will be stored
+    deep_check : bool
+        whether or not to look for the H50s series when more than one is found
+    save_index : bool
+        if True, the header index of raw_data (see DicomIndex) will be saved
+        in temp_dir and re-used if the same folder is checked again
+    staging : str
+        how to make the selected series available in the new folder (see
+        stage_dicoms). Default is 'hardlink', so no pixel data are duplicated
     Returns
     -------
     pth : str
@@ -248,19 +344,24 @@ def dicom_check(raw_data, temp_dir, deep_check=True):
     for character in ILLEGAL_CHARACTERS:
         basename = basename.replace(character, '_')
 
-    sequence_numbers = list(set([str(pydicom.read_file(x).SeriesNumber) for x in dicoms]))
+    if save_index:
+        index_file = os.path.join(temp_dir, '{}_dicom_index.csv'.format(basename))
+    else:
+        index_file = None
+    index = DicomIndex(dicoms, index_file=index_file)
+    sequence_numbers = list(set(index.values('SeriesNumber')))
     if len(sequence_numbers) > 1 and deep_check:
         for n_seq in sequence_numbers:
-            dicom_vols = [x for x in dicoms if n_seq==str(pydicom.read_file(x).SeriesNumber)]
-            dcm_hd = pydicom.read_file(dicom_vols[0])
-            if len(dicom_vols) > 1 and '50s' in dcm_hd.SeriesDescription and not processed:
-                dcm = DicomInfo(dicom_vols)
+            dicom_vols = index.select('SeriesNumber', n_seq)
+            description = index.values('SeriesDescription', dicom_vols[:1])[0]
+            if len(dicom_vols) > 1 and '50s' in description and not processed:
+                dcm = DicomInfo(dicom_vols, index=index)
                 _, tag = dcm.get_tag(['AcquisitionDate', 'SeriesTime'])
                 if len(tag['SeriesTime']) > 1:
-                    dicom_vols = [x for x in dicoms if str(pydicom.read_file(x).SeriesTime)==tag['SeriesTime'][0]]
+                    dicom_vols = index.select('SeriesTime', tag['SeriesTime'][0])
                 folder_name = temp_dir+'/{0}_date_{1}_time_{2}'.format(
                     basename, tag['AcquisitionDate'][0], tag['SeriesTime'][0])
-                slices = [pydicom.read_file(x).InstanceNumber for x in dicom_vols]
+                slices = index.values('InstanceNumber', dicom_vols)
                 if len(slices) != len(set(slices)):
                     print('Duplicate slices found in {} for H50s sequence. Please check. '
                           'This subject will be excluded from the analysis.'.format(raw_data))
@@ -278,12 +379,7 @@ def dicom_check(raw_data, temp_dir, deep_check=True):
         else:
             shutil.rmtree(folder_name)
             os.mkdir(folder_name)
-        for x in dicom_vols:
-            try:
-                shutil.copy2(x, folder_name)
-            except:
-                continue
-        filename = sorted(glob.glob(folder_name+'/*'.format(ext)))[0]
+        filename = stage_dicoms(dicom_vols, folder_name, staging=staging)
 
     else:
         print('No suitable CT data with name containing "H50s" were found in {}'.format(raw_data))
@@ -293,19 +389,65 @@ def dicom_check(raw_data, temp_dir, deep_check=True):
     return filename, folder_name, dcm_info
 
 
+def stage_dicoms(dicoms, folder_name, staging='hardlink'):
+    """Function to make the selected DICOM files available in folder_name
+    without necessarily duplicating them.
+    Parameters
+    ----------
+    dicoms : list
+        paths to the DICOM files of the selected series
+    folder_name : str
+        existing folder where to stage the series
+    staging : str
+        'copy' (copy of each file), 'hardlink' (hard link of each file,
+        it falls back to a copy if the link cannot be created, e.g. across
+        file systems), 'symlink' (symbolic link of each file) or 'manifest'
+        (no files, only a text file listing the original paths. It can be
+        used only with the pydicom DICOM reader)
+    Returns
+    -------
+    filename : str
+        path to the first staged DICOM file (or to the manifest)
+    """
+    if staging == 'manifest':
+        filename = os.path.join(folder_name, DICOM_MANIFEST)
+        with open(filename, 'w') as f:
+            for x in dicoms:
+                f.write(os.path.abspath(x)+'\n')
+        return filename
+    if staging not in ['copy', 'hardlink', 'symlink']:
+        raise Exception('Not recognized staging method "{}". Possible values are "copy", '
+                        '"hardlink", "symlink" or "manifest".'.format(staging))
+    for x in dicoms:
+        staged = os.path.join(folder_name, os.path.basename(x))
+        try:
+            if staging == 'hardlink':
+                os.link(x, staged)
+            elif staging == 'symlink':
+                os.symlink(os.path.abspath(x), staged)
+            else:
+                shutil.copy2(x, staged)
+        except OSError:
+            try:
+                shutil.copy2(x, staged)
+            except OSError as e:
+                LOGGER.error('{0} could not be staged and will be missing from the '
+                             'series: {1}'.format(x, e))
+
+    return sorted(glob.glob(folder_name+'/*'))[0]
+
+
 def binarization(image):
 
     th = threshold_otsu(image)
-    image[image>=th] = 1
-    image[image!=1] = 0
 
-    return image
+    return (image >= th).astype(np.uint8)
 
 
 def normalize(image, method='zscore'):
 
     image = np.asanyarray(image)
-    image = image.astype('float64')
+    image = image.astype(np.float32)
     if method == 'zscore':
         mns = image.mean()
         sstd = image.std()
@@ -323,11 +465,44 @@ def normalize(image, method='zscore'):
     return res
 
 
-def resize_image(image, order=0, new_spacing=(0.1, 0.1, 0.1), save2file=True):
+def resize_image(image, order=0, new_spacing=(0.1, 0.1, 0.1), save2file=True, volume=None):
+    """
+    Function to resample an image to a new spacing.
 
+    Parameters
+    ----------
+    image : str
+        path to the image (NRRD or NIfTI). The resampled image will be saved
+        next to it with the suffix "_resampled"
+    order : int
+        interpolation order: 0 (nearest neighbour) and 1 (linear) use the
+        separable engine of lung_segmentation.resampling, 2 to 5 the splines
+        of skimage.transform.resize
+    new_spacing : tuple
+        target spacing in mm
+    save2file : bool
+        if True, the resampled image is saved to disk
+    volume : tuple
+        optional (array, header) tuple with the NRRD image already in memory
+        (for example a crop of the decoded DICOM volume). If provided, image
+        is used only to build the output name and it does not need to exist.
+
+    Returns
+    -------
+    tuple
+        (resampled image, new shape, output path, original shape) if save2file,
+        otherwise (resampled image, mean resampling factor)
+    """
     basepath, fname, ext = split_filename(image)
     outname = os.path.join(basepath, fname+'_resampled'+ext)
-    if ext == '.nrrd':
+    if volume is not None:
+        image, hd = volume
+        hd = hd.copy()
+        hd['space directions'] = np.array(hd['space directions'], dtype=float)
+        space_x = np.abs(hd['space directions'][0, 0])
+        space_y = np.abs(hd['space directions'][1, 1])
+        space_z = np.abs(hd['space directions'][2, 2])
+    elif ext == '.nrrd':
         image, hd = nrrd.read(image)
         space_x = np.abs(hd['space directions'][0, 0])
         space_y = np.abs(hd['space directions'][1, 1])
@@ -339,10 +514,8 @@ def resize_image(image, order=0, new_spacing=(0.1, 0.1, 0.1), save2file=True):
         space_x, space_y, space_z = hd.get_zooms()
 
     resampling_factor = (new_spacing[0]/space_x, new_spacing[1]/space_y, new_spacing[2]/space_z)
-    new_shape = (image.shape[0]//resampling_factor[0], image.shape[1]//resampling_factor[1],
-                 image.shape[2]//resampling_factor[2])
-    new_image = resize(image.astype(np.float64), new_shape, order=order, mode='edge',
-                       cval=0, anti_aliasing=False)
+    new_shape = new_image_shape(image.shape, (space_x, space_y, space_z), new_spacing)
+    new_image = resample(image, new_shape, order=order)
     if save2file:
         if ext == '.nrrd':
             hd['sizes'] = np.array(new_image.shape)
@@ -438,51 +611,107 @@ def violin_box_plot(to_plot, outname):
     plot.close()
 
 
+def correct_clusters(prediction, th=0.5, min_extent=10000, min_peak=0.95, image=''):
+    """
+    Function to remove the spurious clusters from a predicted probability map.
+
+    Parameters
+    ----------
+    prediction : np.ndarray
+        3D probability map
+    th : float
+        threshold used to define the clusters
+    min_extent : int
+        minimum number of voxels of a cluster
+    min_peak : float
+        a cluster is kept only if its maximum probability is greater than min_peak
+    image : str
+        name of the image, only used for logging
+
+    Returns
+    -------
+    np.ndarray
+        binary uint8 mask with the clusters that survived the correction
+    """
+    labels, n_clusters = ndimage.label(prediction > th, structure=np.ones((3, 3, 3)))
+    if n_clusters == 0:
+        print('No cluster found for image {}.'.format(image))
+        return np.zeros(prediction.shape, dtype=np.uint8)
+    sizes = np.bincount(labels.ravel())
+    peaks = np.asarray(ndimage.maximum(prediction, labels, index=np.arange(1, n_clusters+1)))
+    keep = np.zeros(n_clusters+1, dtype=bool)
+    keep[1:] = (sizes[1:] >= min_extent) & (peaks > min_peak)
+    if keep.sum() > 2:
+        print('Found {0} clusters for image {1}, please check because the'
+              ' usual number of clusters should be not greater than 2.'.format(keep.sum(), image))
+
+    return keep[labels].astype(np.uint8)
+
+
+def body_mask(image, subsampling=4):
+    """
+    Function to compute a mask of the subject(s) in a CT volume, used to skip
+    the patches that contain only air.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        3D CT volume
+    subsampling : int
+        subsampling factor used to compute the Otsu threshold
+
+    Returns
+    -------
+    np.ndarray
+        boolean mask with the voxels above the Otsu threshold, with the holes
+        of each axial slice (i.e. the lungs) filled
+    """
+    th = threshold_otsu(image[::subsampling, ::subsampling, ::subsampling])
+    in_plane = np.zeros((3, 3, 3), dtype=bool)
+    in_plane[:, :, 1] = ndimage.generate_binary_structure(2, 1)
+
+    return ndimage.binary_fill_holes(image > th, structure=in_plane)
+
+
+def roi_bounding_box(prediction, th=0.5, min_fraction=0.1):
+    """
+    Function to compute the bounding box of the lungs from a (coarse)
+    predicted probability map.
+
+    Parameters
+    ----------
+    prediction : np.ndarray
+        3D probability map
+    th : float
+        threshold used to define the clusters
+    min_fraction : float
+        clusters smaller than min_fraction times the biggest one are ignored
+
+    Returns
+    -------
+    list or None
+        (start, stop) indexes of the box along each axis, None if no cluster
+        was found
+    """
+    labels, n_clusters = ndimage.label(prediction > th, structure=np.ones((3, 3, 3)))
+    if n_clusters == 0:
+        return None
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    keep = sizes >= min_fraction*sizes.max()
+    boxes = [box for box, kept in zip(ndimage.find_objects(labels), keep[1:]) if kept]
+
+    return [(min(box[d].start for box in boxes), max(box[d].stop for box in boxes))
+            for d in range(prediction.ndim)]
+
+
 def run_cluster_correction(image, th=0.5, min_extent=10000):
 
-    out_nii = image.split('.nrrd')[0]+'.nii.gz'
-    out_image = out_nii.split('.nii.gz')[0]+'_cc.nii.gz'
-    out_text = out_nii.split('.nii.gz')[0]+'_cc.txt'
-    outname = out_nii.split('.nii.gz')[0]+'_corrected.nii.gz'
-    outname_nrrd = out_nii.split('.nii.gz')[0]+'_corrected.nrrd'
+    outname_nrrd = image.split('.nrrd')[0]+'_corrected.nrrd'
 
     im_nrrd, header_nrrd = nrrd.read(image)
-    nii2save = nib.Nifti1Image(im_nrrd, affine=np.eye(4))
-    nib.save(nii2save, out_nii)
-
-    cmd = 'cluster -i "{0}" -t "{1}" -o "{2}" --minextent={3} --olmax="{4}"'.format(
-        out_nii, th, out_image, min_extent, out_text)
-    _ = sp.check_output(cmd, shell=True)
-    with open(out_text, 'r') as f:
-        res = [x.split() for x in f]
-    mat = np.asarray(res[1:]).astype('float')
-    try:
-        clusters = list(set(mat[mat[:, 1] > 0.95][:, 0]))
-    except:
-        print()
-    add_cmd = None
-    for i, cl in enumerate(clusters):
-        if len(clusters) > 2:
-            print('Found {0} clusters for image {1}, please check because the'
-                  ' usual number of clusters should be not greater than 2.'.format(len(clusters), image))
-        out_cl = image.split('.nii.gz')[0]+'_cc_{}.nii.gz'.format(cl)
-        if len(clusters) > 1:
-            cmd = 'fslmaths "{0}" -uthr {1} -thr {1} -bin "{2}"'.format(out_image, cl, out_cl)
-        else:
-            cmd = 'fslmaths "{0}" -uthr {1} -thr {1} -bin "{2}"'.format(out_image, cl, outname)
-        sp.check_output(cmd, shell=True)
-        if len(clusters) > 1:
-            if i == 0:
-                add_cmd = 'fslmaths "{}" -add'.format(out_cl)
-            elif i == len(clusters)-1:
-                add_cmd = add_cmd + ' "{0}" "{1}"'.format(out_cl, outname)
-            else:
-                add_cmd = add_cmd + ' "{0}" -add'.format(out_cl)
-    if add_cmd is not None:
-        sp.check_output(add_cmd, shell=True)
-
-    nii_im = nib.load(outname).get_data()
-    nrrd.write(outname_nrrd, nii_im, header=header_nrrd)
+    corrected = correct_clusters(im_nrrd, th=th, min_extent=min_extent, image=image)
+    nrrd.write(outname_nrrd, corrected, header=header_nrrd)
 
     return outname_nrrd
 
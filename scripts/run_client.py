@@ -0,0 +1,61 @@
+"""
+Script to send segmentation requests to a running segmentation service
+(see run_service.py). It does not import any deep learning library, so it
+starts immediately.
+"""
+import os
+import sys
+import json
+import argparse
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+
+
+DEFAULT_PORT = 8765
+
+
+def main():
+
+    PARSER = argparse.ArgumentParser()
+
+    PARSER.add_argument('--input_path', '-i', type=str, nargs='+',
+                        help=('NRRD image(s) or DICOM folder(s) to segment.'))
+    PARSER.add_argument('--config', '-c', type=str, default='standard',
+                        choices=['standard', 'high_res', 'human'],
+                        help=('Configuration to use for the segmentation. The service must '
+                              'have been started with the weights for it. Default is "standard".'))
+    PARSER.add_argument('--work_dir', '-w', type=str, default=None,
+                        help=('Directory where to store the results. If not provided, the '
+                              'service will use a new sub-folder of its own working directory.'))
+    PARSER.add_argument('--host', type=str, default='127.0.0.1',
+                        help=('Address of the segmentation service. Default is 127.0.0.1.'))
+    PARSER.add_argument('--port', '-p', type=int, default=DEFAULT_PORT,
+                        help=('Port of the segmentation service. Default is {}.'
+                              .format(DEFAULT_PORT)))
+
+    ARGS = PARSER.parse_args()
+
+    url = 'http://{0}:{1}/segment'.format(ARGS.host, ARGS.port)
+    failed = False
+    for input_path in ARGS.input_path:
+        request = {'input': os.path.abspath(input_path), 'config': ARGS.config}
+        if ARGS.work_dir is not None:
+            request['work_dir'] = os.path.abspath(ARGS.work_dir)
+        data = json.dumps(request).encode('utf-8')
+        try:
+            response = urlopen(Request(url, data=data,
+                                       headers={'Content-Type': 'application/json'}))
+            result = json.loads(response.read().decode('utf-8'))
+            for mask in result['masks']:
+                print(mask)
+        except HTTPError as e:
+            failed = True
+            result = json.loads(e.read().decode('utf-8'))
+            print('Segmentation of {0} failed:\n{1}'.format(input_path, result['error']),
+                  file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
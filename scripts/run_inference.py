@@ -31,6 +31,51 @@ def main():
                               'segmentation can be tested against them. In this case, both '
                               'Dice score and Hausdorff distance will be calculated. '
                               'Default is False.'))
+    PARSER.add_argument('--dicom-reader', type=str, default='mitk', choices=['mitk', 'pydicom'],
+                        help=('Method used to convert the DICOM data. "mitk" uses the '
+                              'MitkCLDicom2Nrrd executable (downloaded from our server), while '
+                              '"pydicom" reads the DICOM series in memory without any external '
+                              'binary. Default is "mitk".'))
+    PARSER.add_argument('--blending', type=str, default='mean',
+                        choices=['mean', 'gaussian', 'linear'],
+                        help=('How overlapping patches are combined when the predictions are '
+                              'stitched back into the volume. "mean" is the plain average, '
+                              '"gaussian" and "linear" give less weight to the patch borders. '
+                              'Default is "mean".'))
+    PARSER.add_argument('--streaming', action='store_true',
+                        help=('If provided, the pre-processed images will be patched, segmented '
+                              'and saved a few at a time (see --streaming-window) instead of '
+                              'all together, so the memory needed does not depend on the '
+                              'number of subjects. Default is False.'))
+    PARSER.add_argument('--streaming-window', type=int, default=1,
+                        help=('Number of images processed together when --streaming is '
+                              'provided. Default is 1.'))
+    PARSER.add_argument('--n-workers', type=int, default=1,
+                        help=('Number of DICOM folders pre-processed in parallel (one process '
+                              'each). Default is 1.'))
+    PARSER.add_argument('--save-intermediates', action='store_true',
+                        help=('If provided, the converted and cropped NRRD images are saved '
+                              'to disk. Otherwise they are kept in memory and only the '
+                              'resampled images are written. Default is False.'))
+    PARSER.add_argument('--whole-slice', action='store_true',
+                        help=('If provided, the network predicts whole axial slices (padded to '
+                              'a multiple of 16 voxels) instead of overlapping 96x96 patches. '
+                              'Default is False.'))
+    PARSER.add_argument('--roi-spacing', nargs='+', type=float, default=None,
+                        help=('If provided (list of 3 values), the lungs are first localized '
+                              'with a coarse prediction of the image resampled to this spacing, '
+                              'and then only the region around them is segmented at full '
+                              'resolution. Useful for human CTs, e.g. 3 3 3. Default is None, '
+                              'so the roi_spacing of the configuration is used (None for all '
+                              'the provided configurations).'))
+    PARSER.add_argument('--roi-margin', type=float, default=None,
+                        help=('Margin (in mm) added around the lungs localized with '
+                              '--roi-spacing. Default is the roi_margin of the configuration.'))
+    PARSER.add_argument('--skip-background', action='store_true',
+                        help=('If provided, the patches that do not contain any part of the '
+                              'subject (body mask obtained with the Otsu threshold) are not '
+                              'fed into the network and their prediction is set to 0. '
+                              'Default is False.'))
 
     ARGS = PARSER.parse_args()
 
@@ -54,6 +99,8 @@ def main():
     CLUSTER_CORRECTION = CONFIG['cluster_correction']
     WEIGHTS_URL = CONFIG['weights_url']
     MIN_EXTENT = CONFIG['min_extent']
+    ROI_SPACING = ARGS.roi_spacing if ARGS.roi_spacing is not None else CONFIG['roi_spacing']
+    ROI_MARGIN = ARGS.roi_margin if ARGS.roi_margin is not None else CONFIG['roi_margin']
 
     os.environ['bin_path'] = BIN_DIR
 
@@ -108,7 +155,9 @@ def main():
                      'and provide them as input with --weights.', WEIGHTS_DIR, WEIGHTS_URL)
         raise Exception('No weight files found!')
 
-    if not os.path.isdir(BIN_DIR):
+    if ARGS.dicom_reader == 'pydicom':
+        LOGGER.info('DICOM data will be read using pydicom, no binary executables needed.')
+    elif not os.path.isdir(BIN_DIR):
         LOGGER.info('No directory containing the binary executables found. '
                     'They will be downloaded from the repository.')
         try:
@@ -127,14 +176,32 @@ def main():
     LOGGER.info('Working directory: %s', ARGS.work_dir)
     LOGGER.info('Root path: %s', ARGS.root_path)
     LOGGER.info('New spacing: %s', NEW_SPACING)
+    if ROI_SPACING is not None:
+        LOGGER.info('Coarse-to-fine localization: spacing %s, margin %s mm',
+                    ROI_SPACING, ROI_MARGIN)
     LOGGER.info('Weight files: \n%s', '\n'.join([x for x in sorted(WEIGHTS)]))
 
     INFERENCE = LungSegmentationInference(ARGS.input_path, ARGS.work_dir, deep_check=DEEP_CHECK)
     INFERENCE.get_data(root_path=ARGS.root_path)
-    INFERENCE.preprocessing(new_spacing=NEW_SPACING, accurate_naming=False)
-    INFERENCE.create_tensors()
-    INFERENCE.run_inference(weights=WEIGHTS)
-    INFERENCE.save_inference(cluster_correction=CLUSTER_CORRECTION, min_extent=MIN_EXTENT)
+    INFERENCE.preprocessing(new_spacing=NEW_SPACING, accurate_naming=False,
+                            conversion_method=ARGS.dicom_reader, n_workers=ARGS.n_workers,
+                            save_converted=ARGS.save_intermediates,
+                            save_cropped=ARGS.save_intermediates)
+    if ARGS.streaming:
+        INFERENCE.run_streaming_inference(WEIGHTS, cluster_correction=CLUSTER_CORRECTION,
+                                          min_extent=MIN_EXTENT, blending=ARGS.blending,
+                                          window=ARGS.streaming_window,
+                                          whole_slice=ARGS.whole_slice,
+                                          roi_spacing=ROI_SPACING, roi_margin=ROI_MARGIN,
+                                          skip_background=ARGS.skip_background)
+    else:
+        if ROI_SPACING is not None:
+            INFERENCE.localize_lungs(WEIGHTS, roi_spacing=ROI_SPACING, margin=ROI_MARGIN)
+        INFERENCE.create_tensors(whole_slice=ARGS.whole_slice,
+                                 skip_background=ARGS.skip_background)
+        INFERENCE.run_inference(weights=WEIGHTS, whole_slice=ARGS.whole_slice)
+        INFERENCE.save_inference(cluster_correction=CLUSTER_CORRECTION, min_extent=MIN_EXTENT,
+                                 blending=ARGS.blending)
     if ARGS.evaluate:
         INFERENCE.run_evaluation()
 
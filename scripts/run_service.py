@@ -0,0 +1,88 @@
+"""
+Script to start the segmentation service. The network weights are loaded
+once and kept in memory, then the segmentation requests sent with
+run_segmentation_client are processed as soon as they arrive.
+"""
+import os
+import argparse
+from lung_segmentation.utils import create_log
+from lung_segmentation.service import SegmentationService, SegmentationServer, DEFAULT_PORT
+
+
+def main():
+
+    PARSER = argparse.ArgumentParser()
+
+    PARSER.add_argument('--work_dir', '-w', type=str,
+                        help=('Directory where to store the results. Each request will be '
+                              'processed in its own sub-folder, unless the client provides '
+                              'a working directory.'))
+    PARSER.add_argument('--standard-weights', nargs='+', type=str, default=[],
+                        help=('Weight files (one per fold) for the standard configuration.'))
+    PARSER.add_argument('--high-res-weights', nargs='+', type=str, default=[],
+                        help=('Weight files (one per fold) for the high resolution '
+                              'configuration.'))
+    PARSER.add_argument('--human-weights', nargs='+', type=str, default=[],
+                        help=('Weight files (one per fold) for the human configuration.'))
+    PARSER.add_argument('--host', type=str, default='127.0.0.1',
+                        help=('Address the service will listen to. Default is 127.0.0.1.'))
+    PARSER.add_argument('--port', '-p', type=int, default=DEFAULT_PORT,
+                        help=('Port the service will listen to. Default is {}.'
+                              .format(DEFAULT_PORT)))
+    PARSER.add_argument('--dicom-reader', type=str, default='mitk', choices=['mitk', 'pydicom'],
+                        help=('Method used to convert the DICOM data. "mitk" uses the '
+                              'MitkCLDicom2Nrrd executable (it must be already present in '
+                              '~/.lung_segmentation/bin), while "pydicom" reads the DICOM '
+                              'series in memory without any external binary. '
+                              'Default is "mitk".'))
+    PARSER.add_argument('--whole-slice', action='store_true',
+                        help=('If provided, the network predicts whole axial slices (padded to '
+                              'a multiple of 16 voxels) instead of overlapping 96x96 patches. '
+                              'Default is False.'))
+    PARSER.add_argument('--skip-background', action='store_true',
+                        help=('If provided, the patches that do not contain any part of the '
+                              'subject (body mask obtained with the Otsu threshold) are not '
+                              'fed into the network and their prediction is set to 0. '
+                              'Default is False.'))
+
+    ARGS = PARSER.parse_args()
+
+    PARENT_DIR = os.path.join(os.path.expanduser("~"), '.lung_segmentation')
+    os.environ['bin_path'] = os.path.join(PARENT_DIR, 'bin/')
+
+    LOG_DIR = os.path.join(ARGS.work_dir, 'logs')
+    if not os.path.isdir(LOG_DIR):
+        os.makedirs(LOG_DIR)
+
+    LOGGER = create_log(LOG_DIR)
+
+    WEIGHTS = {}
+    if ARGS.standard_weights:
+        WEIGHTS['standard'] = ARGS.standard_weights
+    if ARGS.high_res_weights:
+        WEIGHTS['high_res'] = ARGS.high_res_weights
+    if ARGS.human_weights:
+        WEIGHTS['human'] = ARGS.human_weights
+    if not WEIGHTS:
+        LOGGER.error('No weights provided. Please provide the weights for at least one '
+                     'configuration with --standard-weights, --high-res-weights or '
+                     '--human-weights.')
+        raise Exception('No weights provided!')
+
+    SERVICE = SegmentationService(WEIGHTS, ARGS.work_dir, conversion_method=ARGS.dicom_reader,
+                                  whole_slice=ARGS.whole_slice,
+                                  skip_background=ARGS.skip_background)
+    SERVICE.start()
+    SERVER = SegmentationServer(SERVICE, host=ARGS.host, port=ARGS.port)
+    LOGGER.info('Segmentation service listening on %s:%s', ARGS.host, ARGS.port)
+    try:
+        SERVER.serve_forever()
+    except KeyboardInterrupt:
+        LOGGER.info('Stopping the segmentation service.')
+    finally:
+        SERVER.server_close()
+        SERVICE.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -42,6 +42,29 @@ if __name__ == "__main__":
                               'segmentation can be tested against them. In this case, both '
                               'Dice score and Hausdorff distance will be calculated. '
                               'Default is False.'))
+    PARSER.add_argument('--blending', type=str, default='mean',
+                        choices=['mean', 'gaussian', 'linear'],
+                        help=('How overlapping patches are combined when the predictions are '
+                              'stitched back into the volume. "mean" is the plain average, '
+                              '"gaussian" and "linear" give less weight to the patch borders. '
+                              'Default is "mean".'))
+    PARSER.add_argument('--whole-slice', action='store_true',
+                        help=('If provided, the network predicts whole axial slices (padded to '
+                              'a multiple of 16 voxels) instead of overlapping 96x96 patches. '
+                              'Default is False.'))
+    PARSER.add_argument('--roi-spacing', nargs='+', type=float, default=None,
+                        help=('If provided (list of 3 values), the lungs are first localized '
+                              'with a coarse prediction of the image resampled to this spacing, '
+                              'and then only the region around them is segmented at full '
+                              'resolution. Useful for human CTs, e.g. 3 3 3. Default is None.'))
+    PARSER.add_argument('--roi-margin', type=float, default=20,
+                        help=('Margin (in mm) added around the lungs localized with '
+                              '--roi-spacing. Default is 20.'))
+    PARSER.add_argument('--skip-background', action='store_true',
+                        help=('If provided, the patches that do not contain any part of the '
+                              'subject (body mask obtained with the Otsu threshold) are not '
+                              'fed into the network and their prediction is set to 0. '
+                              'Default is False.'))
 
     ARGS = PARSER.parse_args()
 
@@ -74,9 +97,14 @@ if __name__ == "__main__":
     INFERENCE = IndividualInference(ARGS.input_path, ARGS.work_dir)
     INFERENCE.get_data()
     INFERENCE.preprocessing(new_spacing=ARGS.spacing)
-    INFERENCE.create_tensors()
-    INFERENCE.run_inference(weights=ARGS.weights)
+    if ARGS.roi_spacing is not None:
+        INFERENCE.localize_lungs(ARGS.weights, roi_spacing=ARGS.roi_spacing,
+                                 margin=ARGS.roi_margin)
+    INFERENCE.create_tensors(whole_slice=ARGS.whole_slice,
+                             skip_background=ARGS.skip_background)
+    INFERENCE.run_inference(weights=ARGS.weights, whole_slice=ARGS.whole_slice)
     INFERENCE.save_inference(min_extent=ARGS.min_extent,
-                             cluster_correction=ARGS.cluster_correction)
+                             cluster_correction=ARGS.cluster_correction,
+                             blending=ARGS.blending)
 
 print('Done!')
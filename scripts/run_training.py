@@ -67,6 +67,39 @@ def main():
     PARSER.add_argument('--validation-steps', '-vs', type=int, default=None,
                         help=('Number of validation steps per epoch. Default is validation size '
                               'divided by validation batch size.'))
+    PARSER.add_argument('--dicom-reader', type=str, default='mitk', choices=['mitk', 'pydicom'],
+                        help=('Method used to convert the DICOM data. "mitk" uses the '
+                              'MitkCLDicom2Nrrd executable, while "pydicom" reads the DICOM '
+                              'series in memory without any external binary. Default is "mitk".'))
+    PARSER.add_argument('--n-workers', type=int, default=1,
+                        help=('Number of DICOM folders pre-processed in parallel (one process '
+                              'each). Default is 1.'))
+    PARSER.add_argument('--save-intermediates', action='store_true',
+                        help=('If provided, the converted and cropped NRRD images are saved '
+                              'to disk. Otherwise they are kept in memory and only the '
+                              'resampled images are written. Default is False.'))
+    PARSER.add_argument('--data-workers', type=int, default=0,
+                        help=('Number of processes used to load and augment the training '
+                              'batches. 0 means that the batches are loaded by the training '
+                              'process. Default is 0.'))
+    PARSER.add_argument('--sampling', type=str, default='sequential',
+                        choices=['sequential', 'random', 'subject'],
+                        help=('Order of the training patches. "sequential" follows the fold '
+                              'CSV file, "random" shuffles them at every epoch and "subject" '
+                              'visits the subjects in random order, shuffling the patches of '
+                              'each subject (faster reads from the patch archives). '
+                              'Default is "sequential".'))
+    PARSER.add_argument('--foreground-ratio', type=float, default=None,
+                        help=('If provided, every epoch uses all the training patches '
+                              'containing lung and a random subset of the background patches, '
+                              'with this number of lung patches per background patch (e.g. 1 '
+                              'for half and half). This overrides --sampling. Default is None, '
+                              'so all the patches are used.'))
+    PARSER.add_argument('--validation-memory', type=float, default=None,
+                        help=('Maximum memory (in GB) used to keep the validation patches in '
+                              'memory. If they need more, they are written once to the working '
+                              'directory and memory-mapped. Default is None, so they are always '
+                              'kept in memory.'))
 
     ARGS = PARSER.parse_args()
 
@@ -88,7 +121,9 @@ def main():
                                         deep_check=ARGS.dcm_check,
                                         tl=ARGS.transfer_learning)
     WORKFLOW.get_data(root_path=ARGS.root_path, testing=ARGS.testing)
-    WORKFLOW.preprocessing(new_spacing=NEW_SPACING)
+    WORKFLOW.preprocessing(new_spacing=NEW_SPACING, conversion_method=ARGS.dicom_reader,
+                           n_workers=ARGS.n_workers, save_converted=ARGS.save_intermediates,
+                           save_cropped=ARGS.save_intermediates)
     if not ARGS.pre_processing_only:
         WORKFLOW.create_tensors()
         WORKFLOW.data_split(additional_dataset=ARGS.additional_dataset)
@@ -96,7 +131,11 @@ def main():
             n_epochs=ARGS.epochs, keep_training=ARGS.keep_training,
             weight_name=ARGS.pretrained_weights, training_steps=ARGS.training_steps,
             validation_steps=ARGS.validation_steps,
-            data_augmentation=ARGS.use_data_augmentation)
+            data_augmentation=ARGS.use_data_augmentation,
+            num_workers=ARGS.data_workers, sampling=ARGS.sampling,
+            foreground_ratio=ARGS.foreground_ratio,
+            validation_memory=(int(ARGS.validation_memory*1024**3)
+                               if ARGS.validation_memory is not None else None))
     elif ARGS.pre_processing_only and ARGS.create_tensors:
         WORKFLOW.create_tensors()
 
@@ -29,7 +29,9 @@ setup(name='lung_segmentation',
       install_requires=pkgs,
       entry_points={
           'console_scripts': ['run_lung_segmentation = scripts.run_inference:main',
-			      'run_segmentation_training = scripts.run_training:main']},
+			      'run_segmentation_training = scripts.run_training:main',
+			      'run_segmentation_service = scripts.run_service:main',
+			      'run_segmentation_client = scripts.run_client:main']},
       packages=find_packages(exclude=['*.tests', '*.tests.*', 'tests.*', 'tests']),
       classifiers=[
           'Intended Audience :: Science/Research',
@@ -0,0 +1,155 @@
+"Tests of the DataLoader (single and multi process) and of the epoch samplers"
+import random
+import numpy as np
+import pytest
+from lung_segmentation.generators import (DataLoader, SequentialSampler, RandomSampler,
+                                          SubjectSampler, ForegroundSampler)
+
+
+class ArrayDataset():
+    "Dataset of random (image, mask) samples kept in memory"
+    def __init__(self, n_samples=37):
+        rng = np.random.RandomState(0)
+        self.images = rng.rand(n_samples, 8, 8, 1).astype(np.float32)
+        self.masks = (rng.rand(n_samples, 8, 8, 1) > 0.5).astype(np.uint8)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return self.images[index], self.masks[index]
+
+
+def load_batches(loader, n_batches):
+    "Returns copies of the first n_batches batches (the returned ones are views)"
+    iterator = iter(loader)
+    try:
+        return [tuple(np.array(x) for x in next(iterator)) for _ in range(n_batches)]
+    finally:
+        iterator.close()
+
+
+@pytest.mark.parametrize('sampler', [SequentialSampler, RandomSampler])
+def test_loader_workers_same_output(sampler):
+    dataset = ArrayDataset()
+    # 8 batches per epoch, so the epoch rollover is included
+    n_batches = 20
+    single = load_batches(DataLoader(dataset, batch_size=5, num_workers=0,
+                                     sampler=sampler(len(dataset), seed=1)), n_batches)
+    multi = load_batches(DataLoader(dataset, batch_size=5, num_workers=2, held_batches=2,
+                                    sampler=sampler(len(dataset), seed=1)), n_batches)
+    assert len(single) == len(multi) == n_batches
+    for (x0, y0), (x1, y1) in zip(single, multi):
+        assert np.array_equal(x0, x1)
+        assert np.array_equal(y0, y1)
+        assert x1.dtype == np.float32 and y1.dtype == np.uint8
+    # last (partial) batch of the first epoch
+    assert len(single[7][0]) == 2
+
+
+def test_loader_epoch_rollover():
+    dataset = ArrayDataset(10)
+    batches = load_batches(DataLoader(dataset, batch_size=5, num_workers=2,
+                                      sampler=RandomSampler(10, seed=3)), 4)
+    first = np.concatenate([x for x, _ in batches[:2]])
+    second = np.concatenate([x for x, _ in batches[2:]])
+    # each epoch is a permutation of the whole dataset, in a new order
+    for epoch in (first, second):
+        assert sorted(map(bytes, epoch)) == sorted(map(bytes, dataset.images))
+    assert not np.array_equal(first, second)
+
+
+class RandomDataset(ArrayDataset):
+    "Samples drawn with both numpy and random, like the transforms"
+    def __getitem__(self, index):
+        return np.array([np.random.rand(), random.random()], dtype=np.float64)
+
+
+def test_loader_workers_random_states():
+    batches = load_batches(DataLoader(RandomDataset(), batch_size=5, num_workers=2,
+                                      held_batches=4), 4)
+    values = np.concatenate(batches)
+    # forked workers with the same random states would repeat the same values
+    for column in values.T:
+        assert len(np.unique(column)) == len(column)
+
+
+def test_loader_workers_seeded():
+    # the random states of the workers derive from the numpy state of the parent,
+    # random included (it is not re-seeded at fork by old Python versions)
+    runs = []
+    for _ in range(2):
+        np.random.seed(0)
+        runs.append(np.concatenate(load_batches(
+            DataLoader(RandomDataset(), batch_size=5, num_workers=1, held_batches=3), 3)))
+    assert np.array_equal(runs[0], runs[1])
+
+
+def test_loader_propagates_errors():
+
+    class BrokenDataset(ArrayDataset):
+        def __getitem__(self, index):
+            if index == 7:
+                raise ValueError('broken sample')
+            return ArrayDataset.__getitem__(self, index)
+
+    with pytest.raises(ValueError):
+        load_batches(DataLoader(BrokenDataset(), batch_size=5, num_workers=2), 2)
+
+
+def test_sampler_state_dict_resume():
+    sampler = RandomSampler(50, 20, seed=5)
+    indices = iter(sampler)
+    seen = [next(indices) for _ in range(27)]
+    state = sampler.state_dict()
+    assert state == {'seed': 5, 'epoch': 0, 'position': 27}
+
+    resumed = RandomSampler(50, 20)
+    resumed.load_state_dict(state)
+    rest = list(resumed)
+    assert seen + rest == list(RandomSampler(50, 20, seed=5))
+    # each pass over the data is a permutation, with its own order
+    full = np.asarray(seen + rest)
+    assert sorted(full[:20]) == sorted(full[20:40]) == list(range(20))
+    assert not np.array_equal(full[:20], full[20:40])
+    assert full.dtype == np.int64
+
+
+def test_sampler_epochs():
+    sampler = RandomSampler(30, seed=2)
+    first = list(sampler)
+    sampler.set_epoch(1)
+    second = list(sampler)
+    sampler.set_epoch(0)
+    assert list(sampler) == first
+    assert first != second
+
+
+def test_loader_resumes_from_sampler_position():
+    dataset = ArrayDataset(20)
+    sampler = SequentialSampler(20)
+    sampler.load_state_dict({'seed': 0, 'epoch': 0, 'position': 15})
+    batches = load_batches(DataLoader(dataset, batch_size=5, sampler=sampler), 2)
+    assert np.array_equal(batches[0][0], dataset.images[15:20])
+    assert np.array_equal(batches[1][0], dataset.images[:5])
+
+
+def test_subject_sampler_groups():
+    groups = np.repeat(['a', 'b', 'c', 'd'], 5)
+    order = np.asarray(list(SubjectSampler(groups, seed=0)))
+    assert sorted(order) == list(range(20))
+    # the elements of each subject are consecutive
+    visited = groups[order]
+    assert all(len(set(visited[i:i+5])) == 1 for i in range(0, 20, 5))
+
+
+def test_foreground_sampler_ratio():
+    foreground = np.zeros(100)
+    foreground[:24] = 0.3
+    sampler = ForegroundSampler(foreground, ratio=2, seed=0)
+    assert len(sampler) == 36
+    indices = np.asarray(list(sampler))
+    assert set(range(24)).issubset(indices)
+    assert np.count_nonzero(indices >= 24) == 12
+    sampler.set_epoch(1)
+    assert set(indices[indices >= 24]) != set(i for i in sampler if i >= 24)
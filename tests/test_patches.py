@@ -0,0 +1,101 @@
+"Tests of the patch archives and of the datasets reading them"
+import os
+import csv
+import pickle
+import numpy as np
+import pytest
+from lung_segmentation.patches import PatchArchive, read_patch_index, find_patch_indexes
+from lung_segmentation.dataloader import PatchArchiveDataset, CachedPatchDataset
+
+
+@pytest.fixture
+def archives(tmpdir):
+    "Two images with 6 patches each, the first 6 rows are training and the others test"
+    rng = np.random.RandomState(0)
+    images = []
+    masks = []
+    rows = []
+    for n in range(2):
+        archive = PatchArchive(os.path.join(str(tmpdir), 'image{}'.format(n)), 6,
+                               patch_size=(16, 16),
+                               mask_basename=os.path.join(str(tmpdir), 'mask{}'.format(n)))
+        image = rng.rand(6, 16, 16, 1)
+        mask = np.zeros((6, 16, 16, 1))
+        mask[::2, :8] = 1
+        archive.images[:] = image
+        archive.masks[:] = mask
+        index = archive.close()
+        images.append(image.astype(np.float16))
+        masks.append(mask.astype(np.uint8))
+        rows += [row + ('train' if n == 0 else 'test',) for row in read_patch_index(index)]
+    csv_file = os.path.join(str(tmpdir), 'filemap.csv')
+    with open(csv_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['images', 'masks', 'patch', 'foreground', 'train-test'])
+        writer.writerows(rows)
+
+    return csv_file, np.concatenate(images), np.concatenate(masks)
+
+
+def test_patch_archive_round_trip(archives, tmpdir):
+    _, images, masks = archives
+    indexes = find_patch_indexes(str(tmpdir))
+    assert len(indexes) == 2
+    rows = read_patch_index(indexes[0])
+    assert [x[2] for x in rows] == list(range(6))
+    assert [x[3] for x in rows] == [0.5, 0, 0.5, 0, 0.5, 0]
+    stored = np.load(rows[0][0], mmap_mode='r')
+    assert stored.dtype == np.float16
+    assert np.array_equal(stored, images[:6])
+    stored = np.load(rows[0][1], mmap_mode='r')
+    assert stored.dtype == np.uint8
+    assert np.array_equal(stored, masks[:6])
+
+
+def test_patch_archive_dataset(archives):
+    csv_file, images, masks = archives
+    dataset = PatchArchiveDataset(csv_file, base_path='')
+    assert len(dataset) == 12
+    assert np.array_equal(dataset.foreground, [0.5, 0, 0.5, 0, 0.5, 0]*2)
+    x, y = dataset[7]
+    assert np.array_equal(x, images[7]) and np.array_equal(y, masks[7])
+    indices = [11, 0, 6, 3]
+    x, y = dataset.get_batch(indices)
+    assert np.array_equal(x, images[indices]) and np.array_equal(y, masks[indices])
+    # the memory maps are re-opened after pickling (e.g. in the worker processes)
+    x, y = pickle.loads(pickle.dumps(dataset)).get_batch(indices)
+    assert np.array_equal(x, images[indices])
+
+
+@pytest.mark.parametrize('max_memory', [None, 1])
+def test_cached_patch_dataset(archives, tmpdir, max_memory):
+    csv_file, images, masks = archives
+    validation, _ = PatchArchiveDataset(csv_file, base_path='').split_by_column('train-test')
+    cached = CachedPatchDataset(validation, max_memory=max_memory, cache_dir=str(tmpdir),
+                                chunk_size=4)
+    assert cached.memory_mapped == (max_memory is not None)
+    assert len(cached) == 6
+    assert cached.inputs.dtype == np.float16 and cached.targets.dtype == np.uint8
+    # the validation rows are the second image
+    x, y = cached.get_batch(np.arange(6))
+    assert np.array_equal(x, images[6:]) and np.array_equal(y, masks[6:])
+    x, y = cached.get_batch([5, 1])
+    assert np.array_equal(x, images[[11, 7]])
+    restored = pickle.loads(pickle.dumps(cached))
+    assert np.array_equal(restored.inputs, images[6:])
+    if max_memory is not None:
+        assert os.path.isfile(os.path.join(str(tmpdir), 'cached_images.npy'))
+        assert isinstance(restored.inputs, np.memmap)
+
+
+def test_cached_patch_dataset_needs_cache_dir(archives):
+    csv_file, _, _ = archives
+    with pytest.raises(ValueError):
+        CachedPatchDataset(PatchArchiveDataset(csv_file, base_path=''), max_memory=1)
+
+
+def test_cached_patch_dataset_empty(archives):
+    csv_file, _, _ = archives
+    dataset = PatchArchiveDataset(csv_file, base_path='')
+    with pytest.raises(ValueError):
+        CachedPatchDataset(dataset.copy(dataset.df.iloc[:0]))
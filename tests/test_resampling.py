@@ -0,0 +1,67 @@
+"Tests of the separable resampling against skimage.transform.resize"
+import threading
+import numpy as np
+import pytest
+from skimage.transform import resize
+from lung_segmentation.resampling import resample, new_image_shape, Resampler
+
+
+SHAPES = [(45, 38, 30), (20, 17, 12), (32, 32, 24)]
+
+
+def skimage_resize(image, shape, order):
+    return resize(image.astype(np.float64), shape, order=order, mode='edge', cval=0,
+                  anti_aliasing=False)
+
+
+@pytest.fixture
+def volume():
+    rng = np.random.RandomState(0)
+    return np.asfortranarray((rng.rand(32, 28, 20)*2000-1000).astype(np.int16))
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_nearest_neighbour(volume, shape):
+    resampled = resample(volume, shape, order=0)
+    assert resampled.dtype == np.int16
+    assert np.array_equal(resampled, skimage_resize(volume, shape, 0))
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_linear(volume, shape):
+    reference = skimage_resize(volume, shape, 1)
+    resampled = resample(volume.astype(np.float32), shape, order=1)
+    assert resampled.dtype == np.float32
+    assert np.allclose(resampled, reference, atol=1e-2)
+    # integer outputs are rounded
+    resampled = resample(volume, shape, order=1)
+    assert resampled.dtype == np.int16
+    assert np.abs(resampled - reference).max() <= 0.5 + 1e-2
+
+
+def test_spline_orders_use_skimage(volume):
+    resampled = resample(volume.astype(np.float32), SHAPES[0], order=3)
+    assert np.allclose(resampled, skimage_resize(volume, SHAPES[0], 3), atol=1e-2)
+
+
+def test_concurrent_calls(volume):
+    resampler = Resampler(n_threads=2, chunk_size=4)
+    image = volume.astype(np.float32)
+    errors = []
+
+    def run(shape):
+        reference = skimage_resize(image, shape, 1)
+        for _ in range(5):
+            errors.append(np.abs(resampler.resample(image, shape, order=1) - reference).max())
+
+    threads = [threading.Thread(target=run, args=(shape,)) for shape in SHAPES]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 15 and max(errors) < 1e-2
+
+
+def test_new_image_shape():
+    assert new_image_shape((512, 512, 300), (0.7, 0.7, 1.5), (1, 1, 1)) == (358, 358, 450)
+    assert new_image_shape((10, 10, 1), (1, 1, 1), (5, 5, 5)) == (2, 2, 1)
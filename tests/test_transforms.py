@@ -0,0 +1,41 @@
+"Tests of the batched affine augmentation"
+import numpy as np
+from lung_segmentation import transforms as tx
+
+
+def random_affine():
+    return tx.RandomAffine(rotation_range=(-35, 35), translation_range=(0.4, 0.4),
+                           shear_range=(-30, 30), zoom_range=(0.45, 1.55),
+                           turn_off_frequency=5, fill_value='min',
+                           target_fill_mode='constant', target_fill_value='min')
+
+
+def test_transform_batch_same_as_single_samples():
+    rng = np.random.RandomState(0)
+    images = rng.rand(12, 32, 32, 1).astype(np.float16)
+    masks = (rng.rand(12, 32, 32, 1) > 0.7).astype(np.uint8)
+    affine = random_affine()
+    np.random.seed(3)
+    batch_images, batch_masks = affine.transform_batch(images, masks)
+    assert batch_images.dtype == np.float32 and batch_masks.dtype == np.uint8
+
+    affine = random_affine()
+    np.random.seed(3)
+    matrices = affine.sample_matrices(12, images.shape[1:])
+    for n in range(12):
+        image = tx.apply_transform(images[n], matrices[n], fill_mode='constant',
+                                   fill_value='min')
+        mask = tx.apply_transform(masks[n], matrices[n], fill_mode='constant',
+                                  fill_value='min')
+        assert np.array_equal(image, batch_images[n])
+        assert np.array_equal(mask.astype(np.uint8), batch_masks[n])
+
+
+def test_get_params_after_transform_batch():
+    affine = random_affine()
+    images = np.zeros((4, 16, 16, 1), dtype=np.float32)
+    affine.transform_batch(images, images.astype(np.uint8))
+    params = affine.get_params()
+    assert sorted(params) == ['rotation', 'shear', 'translation', 'zoom']
+    assert -35 <= params['rotation'] <= 35
+    assert all(0.45 <= x <= 1.55 for x in params['zoom'])